@@ -22,6 +22,7 @@ setup(
         "scripts/oak-prepare-shutdown",
         "scripts/oak-purge-master-logs",
         "scripts/oak-repeat-query",
+        "scripts/oak-replay-general-log",
         "scripts/oak-security-audit",
         "scripts/oak-show-limits",
         "scripts/oak-show-replication-status",
@@ -19,7 +19,11 @@
 
 import getpass
 import MySQLdb
+import os
 import sys
+import threading
+import time
+import traceback
 from optparse import OptionParser
 
 def parse_options():
@@ -32,7 +36,25 @@ def parse_options():
     parser.add_option("-P", "--port", dest="port", type="int", default="3306", help="TCP/IP port (default: 3306)")
     parser.add_option("-S", "--socket", dest="socket", default="/var/run/mysqld/mysql.sock", help="MySQL socket file. Only applies when host is localhost")
     parser.add_option("", "--defaults-file", dest="defaults_file", default="", help="Read from MySQL configuration file. Overrides all other options")
-    parser.add_option("-e", "--error-if-more-than-seconds", dest="error_if_more_than_seconds", type="int", default=None, help="Return with error exit code if slave lag is more than given number of seconds (default: disabled)")
+    parser.add_option("-e", "--error-if-more-than-seconds", dest="error_if_more_than_seconds", type="float", default=None, help="Return with error exit code if slave lag is more than given number of seconds (default: disabled)")
+    parser.add_option("", "--heartbeat-table", dest="heartbeat_table", default=None, help="Measure lag by heartbeat table (schema.table), written by --write-heartbeat on the master, rather than by Seconds_Behind_Master")
+    parser.add_option("", "--heartbeat-server-id", dest="heartbeat_server_id", type="int", default=None, help="Measure lag against heartbeat written by given server (default: most recent heartbeat not written by this server)")
+    parser.add_option("", "--write-heartbeat", dest="write_heartbeat", action="store_true", default=False, help="Keep running, writing heartbeat into --heartbeat-table. Run on master")
+    parser.add_option("", "--heartbeat-interval-ms", dest="heartbeat_interval_ms", type="int", default=100, help="Milliseconds between heartbeats when writing (default: 100)")
+    parser.add_option("", "--slaves", dest="slaves", default=None, help="Comma delimited slaves (host or host:port) to query lag on, concurrently, printing one line for all")
+    parser.add_option("", "--discover-slaves", dest="discover_slaves", action="store_true", default=False, help="Query lag on all slaves listed by SHOW SLAVE HOSTS on given (master) host, concurrently")
+    parser.add_option("", "--connect-timeout-seconds", dest="connect_timeout_seconds", type="int", default=5, help="With --slaves or --discover-slaves: per slave connect timeout (default: 5)")
+    parser.add_option("", "--read-timeout-seconds", dest="read_timeout_seconds", type="int", default=5, help="With --slaves or --discover-slaves: per slave time allowed for reading lag, once connected (default: 5)")
+    parser.add_option("", "--write-status-file", dest="write_status_file", default=None, help="Keep running, reading lag every --interval seconds (on given host or on --slaves/--discover-slaves), and writing it into given status file")
+    parser.add_option("", "--read-status-file", dest="read_status_file", default=None, help="Read lag from status file written by --write-status-file, rather than from MySQL")
+    parser.add_option("", "--max-status-age-seconds", dest="max_status_age_seconds", type="float", default=10, help="With --read-status-file: status older than given seconds is considered unknown lag (default: 10)")
+    parser.add_option("", "--watch", dest="watch", action="store_true", default=False, help="Keep running, sampling lag every --interval seconds and periodically reporting lag statistics")
+    parser.add_option("", "--interval", dest="interval", type="float", default=1.0, help="Seconds between lag readings in watch mode and with --write-status-file (default: 1)")
+    parser.add_option("", "--report-interval", dest="report_interval", type="int", default=60, help="Seconds between lag statistics reports in watch mode (default: 60)")
+    parser.add_option("", "--windows", dest="windows", default="60,300,3600", help="Comma delimited sliding windows, in seconds, over which lag statistics are reported in watch mode (default: 60,300,3600)")
+    parser.add_option("", "--samples-file", dest="samples_file", default=None, help="In watch mode, append lag samples to given file, rotated into <file>.1 when exceeding --samples-file-max-mb")
+    parser.add_option("", "--samples-file-max-mb", dest="samples_file_max_mb", type="int", default=10, help="Size at which samples file is rotated (default: 10)")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", help="Print user friendly messages")
     parser.add_option("", "--debug", dest="debug", action="store_true", help="Print stack trace on error")
     return parser.parse_args()
 
@@ -44,21 +66,35 @@ def verbose(message):
 def print_error(message):
     sys.stderr.write("-- ERROR: %s\n" % message)
 
-def open_connection():
+def open_connection(host=None, port=None):
+    """
+    Open a connection; to given host and port, if provided. 
+    Reconnecting, or connecting to other hosts, reuses the password given (or prompted) on first connection.
+    """
+    global connection_password
+    
+    connect_args = {}
+    if host is not None:
+        connect_args = {"host": host, "port": port, "connect_timeout": options.connect_timeout_seconds}
     if options.defaults_file:
         conn = MySQLdb.connect(
-            read_default_file = options.defaults_file)
+            read_default_file = options.defaults_file,
+            **connect_args)
     else:
-        if options.prompt_password:
-            password=getpass.getpass()
-        else:
-            password=options.password
+        if connection_password is None:
+            if options.prompt_password:
+                connection_password=getpass.getpass()
+            else:
+                connection_password=options.password
+        connect_args.setdefault("host", options.host)
+        connect_args.setdefault("port", options.port)
         conn = MySQLdb.connect(
-            host = options.host,
             user = options.user,
-            passwd = password,
-            port = options.port,
-            unix_socket = options.socket)
+            passwd = connection_password,
+            unix_socket = options.socket,
+            **connect_args)
+    # Connections are kept open across readings; each reading must see the current heartbeat, not a snapshot
+    conn.autocommit(True)
     return conn;
 
 
@@ -74,8 +110,9 @@ def act_query(query):
     return num_affected_rows
 
 
-def get_row(query):
-    connection = conn
+def get_row(query, connection=None):
+    if connection is None:
+        connection = conn
     cursor = connection.cursor(MySQLdb.cursors.DictCursor)
     cursor.execute(query)
     row = cursor.fetchone()
@@ -94,8 +131,8 @@ def get_rows(query):
     return rows
 
 
-def get_slave_delay_seconds():
-    slave_status = get_row("SHOW SLAVE STATUS")
+def get_slave_delay_seconds(connection=None):
+    slave_status = get_row("SHOW SLAVE STATUS", connection)
     if slave_status is None:
         return None
     seconds_behind_master_value = slave_status["Seconds_Behind_Master"]
@@ -104,20 +141,372 @@ def get_slave_delay_seconds():
     return int(seconds_behind_master_value)
 
 
+def create_heartbeat_table():
+    """
+    Create the heartbeat table, unless it already exists: one row per writing server, 
+    holding the writer's epoch time in microsecond resolution.
+    """
+    act_query("""
+        CREATE TABLE IF NOT EXISTS %s (
+            server_id INT UNSIGNED NOT NULL,
+            ts DECIMAL(17,6) NOT NULL,
+            PRIMARY KEY(server_id)
+        ) ENGINE=InnoDB
+        """ % options.heartbeat_table)
+
+
+def write_heartbeat():
+    """
+    Keep on writing the current time into the heartbeat table, every --heartbeat-interval-ms milliseconds.
+    The time is taken on this (client) host rather than by the server, thus independent of the server's
+    time resolution and of the binary log format. Reconnect upon connection error.
+    """
+    global conn
+
+    create_heartbeat_table()
+    # Evaluated here, since @@server_id would evaluate on the slaves under statement based replication
+    server_id = int(get_row("SELECT @@global.server_id AS server_id")["server_id"])
+    verbose("Writing heartbeat for server_id %d every %d ms" % (server_id, options.heartbeat_interval_ms))
+    interval_seconds = options.heartbeat_interval_ms / 1000.0
+    while True:
+        try:
+            if conn is None:
+                conn = open_connection()
+            act_query("REPLACE INTO %s (server_id, ts) VALUES (%d, %.6f)" % (options.heartbeat_table, server_id, time.time()))
+        except MySQLdb.Error, err:
+            print_error(err)
+            try:
+                conn.close()
+            except:
+                pass
+            conn = None
+        time.sleep(interval_seconds - (time.time() % interval_seconds))
+
+
+def get_heartbeat_lag_seconds(connection=None):
+    """
+    Return the lag, in seconds and fractions, of the most recent heartbeat replicated into this server.
+    Requires the clocks of the writing and reading hosts to be synchronized (e.g. by NTP).
+    """
+    if options.heartbeat_server_id is None:
+        condition = "server_id != @@global.server_id"
+    else:
+        condition = "server_id = %d" % options.heartbeat_server_id
+    row = get_row("SELECT MAX(ts) AS ts FROM %s WHERE %s" % (options.heartbeat_table, condition), connection)
+    if row is None or row["ts"] is None:
+        return None
+    return max(0.0, time.time() - float(row["ts"]))
+
+
+def get_lag_seconds(connection=None):
+    """
+    Return the slave lag, by heartbeat if so requested, otherwise as reported by SHOW SLAVE STATUS
+    """
+    if options.heartbeat_table:
+        return get_heartbeat_lag_seconds(connection)
+    return get_slave_delay_seconds(connection)
+
+
+def get_lag_presentation(lag_seconds):
+    """
+    Heartbeat lag is presented in milliseconds resolution
+    """
+    if isinstance(lag_seconds, float):
+        return "%.3f" % lag_seconds
+    return lag_seconds
+
+
+def get_windows():
+    """
+    Return the statistics windows, in seconds, ascending
+    """
+    windows = [int(window) for window in options.windows.split(",") if window.strip()]
+    if not windows or min(windows) <= 0:
+        exit_with_error("--windows must list positive numbers of seconds")
+    windows.sort()
+    return windows
+
+
+def record_lag_sample(sample_time, lag_seconds):
+    """
+    Record a sample into the ring buffer, overwriting the oldest sample once full. 
+    The buffer is sized to hold the longest window's worth of samples.
+    """
+    global samples_index
+    
+    samples[samples_index] = (sample_time, lag_seconds)
+    samples_index = (samples_index + 1) % len(samples)
+
+
+def write_lag_sample(sample_time, lag_seconds):
+    """
+    Append a sample to the samples file; rotate the file when it grows too large, such that
+    no more than twice --samples-file-max-mb are ever used.
+    """
+    global samples_file
+    
+    if samples_file is None:
+        samples_file = open(options.samples_file, "a")
+    samples_file.write("%.3f\t%s\n" % (sample_time, get_lag_presentation(lag_seconds)))
+    if samples_file.tell() >= options.samples_file_max_mb * 1024 * 1024:
+        samples_file.close()
+        os.rename(options.samples_file, "%s.1" % options.samples_file)
+        samples_file = None
+        verbose("Rotated %s" % options.samples_file)
+
+
+def get_window_statistics(window, now):
+    """
+    Return a line of lag statistics over samples taken within the last given seconds
+    """
+    window_samples = [lag_seconds for (sample_time, lag_seconds) in samples if sample_time is not None and sample_time > now - window]
+    lags = [float(lag_seconds) for lag_seconds in window_samples if lag_seconds is not None]
+    num_missing = len(window_samples) - len(lags)
+    if not lags:
+        return "window=%ds samples=%d missing=%d" % (window, len(window_samples), num_missing)
+    lags.sort()
+    return "window=%ds samples=%d missing=%d min=%.3f avg=%.3f p50=%.3f p99=%.3f max=%.3f" % (
+        window, len(window_samples), num_missing, lags[0], sum(lags) / len(lags), 
+        lags[min(len(lags) - 1, int(len(lags) * 0.5))], lags[min(len(lags) - 1, int(len(lags) * 0.99))], lags[-1])
+
+
+def print_lag_statistics(windows, now):
+    report_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))
+    for window in windows:
+        print "%s %s" % (report_time, get_window_statistics(window, now))
+    sys.stdout.flush()
+
+
+def watch_slave_lag():
+    """
+    Sample lag every --interval seconds over a persistent connection, and report statistics over sliding windows 
+    every --report-interval seconds. A sample is missing when replication does not run or on connection error, 
+    upon which we reconnect.
+    """
+    global conn, samples
+    
+    windows = get_windows()
+    samples = [(None, None)] * (int(max(windows) / options.interval) + 1)
+    verbose("Sampling every %s seconds, reporting every %d seconds" % (options.interval, options.report_interval))
+    next_report_time = time.time() + options.report_interval
+    while True:
+        sample_time = time.time()
+        lag_seconds = None
+        try:
+            if conn is None:
+                conn = open_connection()
+            lag_seconds = get_lag_seconds()
+        except MySQLdb.Error, err:
+            print_error(err)
+            try:
+                conn.close()
+            except:
+                pass
+            conn = None
+        record_lag_sample(sample_time, lag_seconds)
+        if options.samples_file:
+            write_lag_sample(sample_time, lag_seconds)
+        if sample_time >= next_report_time:
+            print_lag_statistics(windows, sample_time)
+            if samples_file:
+                samples_file.flush()
+            next_report_time += options.report_interval
+        time.sleep(max(0, options.interval - (time.time() - sample_time)))
+
+
 def get_slave_lag():
     try:
-        seconds_behind_master = get_slave_delay_seconds()
+        seconds_behind_master = get_lag_seconds()
         if options.error_if_more_than_seconds is None:
-            print seconds_behind_master
+            print get_lag_presentation(seconds_behind_master)
         elif seconds_behind_master is None or seconds_behind_master > options.error_if_more_than_seconds:
-            exit_with_error(seconds_behind_master)
+            exit_with_error(get_lag_presentation(seconds_behind_master))
         else:    
-            print seconds_behind_master
+            print get_lag_presentation(seconds_behind_master)
     except Exception, err:
         if options.debug:
             traceback.print_exc()
         print err
 
+def get_slave_hosts():
+    """
+    Return the slaves as (host, port) tuples: as listed by --slaves, or as reported by SHOW SLAVE HOSTS on the master.
+    The latter requires slaves to be configured with report_host.
+    """
+    slave_hosts = []
+    if options.discover_slaves:
+        for slave_host in get_rows("SHOW SLAVE HOSTS"):
+            if not slave_host["Host"]:
+                print_error("Slave with server_id %s does not report its host; skipping" % slave_host["Server_id"])
+                continue
+            slave_hosts.append((slave_host["Host"], int(slave_host["Port"])))
+    else:
+        for slave in options.slaves.split(","):
+            slave = slave.strip()
+            if not slave:
+                continue
+            host, port = slave, options.port
+            if slave.find(":") >= 0:
+                host, port = slave.rsplit(":", 1)
+                port = int(port)
+            slave_hosts.append((host, port))
+    return slave_hosts
+
+
+def get_host_lag(slave_lag):
+    """
+    Read lag on a single slave, over a connection of its own. Runs in a thread of its own,
+    such that an unresponsive slave does not hold back others.
+    """
+    connection = None
+    try:
+        try:
+            connection = open_connection(slave_lag["host"], slave_lag["port"])
+            slave_lag["lag"] = get_lag_seconds(connection)
+            slave_lag["status"] = "done"
+        except Exception, err:
+            slave_lag["status"] = "error"
+            print_error("%s: %s" % (slave_lag["name"], err))
+    finally:
+        if connection:
+            try:
+                connection.close()
+            except:
+                pass
+
+
+def get_slaves_lag_line():
+    """
+    Read lag on all slaves concurrently, allowing each up to --connect-timeout-seconds plus --read-timeout-seconds.
+    Return the worst lag, and a line of the worst lag followed by the lag per slave. 
+    A slave not replicating, failing or timing out counts as worst.
+    A slave whose probe from a previous reading (with --write-status-file) is still hanging is not probed again, 
+    and is reported as timing out: a hung slave thus holds at most one thread and one connection.
+    """
+    slave_lags = []
+    slave_threads = []
+    for (host, port) in get_slave_hosts():
+        name = "%s:%d" % (host, port)
+        if slave_probe_threads.has_key(name) and slave_probe_threads[name].isAlive():
+            slave_lags.append({"name": name, "lag": None, "status": "timeout"})
+            continue
+        slave_lag = {"name": name, "host": host, "port": port, "lag": None, "status": "timeout"}
+        slave_thread = threading.Thread(target=get_host_lag, args=(slave_lag,))
+        slave_thread.setDaemon(True)
+        slave_probe_threads[name] = slave_thread
+        slave_lags.append(slave_lag)
+        slave_threads.append(slave_thread)
+    if not slave_lags:
+        print_error("No slaves found")
+        return None, "None"
+    verbose("Reading lag on %d slaves" % len(slave_threads))
+    for slave_thread in slave_threads:
+        slave_thread.start()
+    deadline = time.time() + options.connect_timeout_seconds + options.read_timeout_seconds
+    for slave_thread in slave_threads:
+        slave_thread.join(max(0, deadline - time.time()))
+
+    lags = [slave_lag["lag"] for slave_lag in slave_lags]
+    if None in lags:
+        worst_lag = None
+    else:
+        worst_lag = max(lags)
+    slave_lag_presentations = []
+    for slave_lag in slave_lags:
+        if slave_lag["status"] == "done":
+            slave_lag_presentations.append("%s=%s" % (slave_lag["name"], get_lag_presentation(slave_lag["lag"])))
+        else:
+            slave_lag_presentations.append("%s=%s" % (slave_lag["name"], slave_lag["status"]))
+    return worst_lag, "%s %s" % (get_lag_presentation(worst_lag), " ".join(slave_lag_presentations))
+
+
+def get_slaves_lag():
+    """
+    Print the worst lag followed by the lag per slave, on one line. 
+    Exit with error when the worst lag exceeds --error-if-more-than-seconds.
+    """
+    worst_lag, lag_line = get_slaves_lag_line()
+    print lag_line
+    sys.stdout.flush()
+    if options.error_if_more_than_seconds is not None:
+        if worst_lag is None or worst_lag > options.error_if_more_than_seconds:
+            exit(1)
+
+
+def write_status(status_line):
+    """
+    Replace the status file. Readers see either the former or the new status in whole, never a partial one.
+    """
+    temporary_status_file_name = "%s.tmp" % options.write_status_file
+    status_file = open(temporary_status_file_name, "w")
+    try:
+        status_file.write(status_line)
+    finally:
+        status_file.close()
+    os.rename(temporary_status_file_name, options.write_status_file)
+
+
+def serve_status_file():
+    """
+    Read lag every --interval seconds, on this server or on all slaves, and write it, along with the reading time, 
+    into the status file. Any number of local consumers then read the file (--read-status-file) at the cost 
+    of a file read, rather than each connecting to the servers. Reconnect upon connection error.
+    """
+    global conn
+    
+    verbose("Writing lag into %s every %s seconds" % (options.write_status_file, options.interval))
+    while True:
+        poll_time = time.time()
+        try:
+            if conn is None and not options.slaves:
+                # Kept across polls. Being in autocommit mode, each poll reads current heartbeat rather than a snapshot
+                conn = open_connection()
+            if options.slaves or options.discover_slaves:
+                worst_lag, lag_line = get_slaves_lag_line()
+            else:
+                lag_line = get_lag_presentation(get_lag_seconds())
+        except MySQLdb.Error, err:
+            print_error(err)
+            try:
+                conn.close()
+            except:
+                pass
+            conn = None
+            lag_line = "None"
+        write_status("%.3f %s\n" % (poll_time, lag_line))
+        time.sleep(max(0, options.interval - (time.time() - poll_time)))
+
+
+def read_status_file():
+    """
+    Print lag as last written by --write-status-file. A missing or stale status is unknown lag.
+    Exit with error when lag exceeds --error-if-more-than-seconds.
+    """
+    try:
+        status_file = open(options.read_status_file)
+        try:
+            status_tokens = status_file.readline().split()
+        finally:
+            status_file.close()
+        status_time = float(status_tokens[0])
+        lag_line = " ".join(status_tokens[1:])
+    except (IOError, ValueError, IndexError), err:
+        exit_with_error("Cannot read status from %s: %s" % (options.read_status_file, err))
+    status_age_seconds = time.time() - status_time
+    if status_age_seconds > options.max_status_age_seconds:
+        exit_with_error("Status in %s is %.1f seconds old" % (options.read_status_file, status_age_seconds))
+    if status_tokens[1] == "None":
+        lag_seconds = None
+    else:
+        lag_seconds = float(status_tokens[1])
+    if options.error_if_more_than_seconds is None:
+        print lag_line
+    elif lag_seconds is None or lag_seconds > options.error_if_more_than_seconds:
+        exit_with_error(lag_line)
+    else:    
+        print lag_line
+
+
 def exit_with_error(error_message):
     """
     Notify and exit.
@@ -129,13 +518,50 @@ def exit_with_error(error_message):
 try:
     try:
         conn = None
+        connection_password = None
+        samples = []
+        samples_index = 0
+        samples_file = None
+        slave_probe_threads = {}
         reuse_conn = True
         (options, args) = parse_options()
 
-        conn = open_connection()
-        get_slave_lag()
+        if options.write_heartbeat and not options.heartbeat_table:
+            exit_with_error("--write-heartbeat requires --heartbeat-table")
+        if (options.slaves or options.discover_slaves) and (options.write_heartbeat or options.watch):
+            exit_with_error("--slaves and --discover-slaves do not apply to --write-heartbeat and --watch")
+        if options.write_status_file and (options.write_heartbeat or options.watch):
+            exit_with_error("--write-status-file does not apply to --write-heartbeat and --watch")
+        if (options.watch or options.write_status_file) and options.interval <= 0:
+            exit_with_error("--interval must be positive")
+        if options.read_status_file:
+            read_status_file()
+        elif options.write_status_file:
+            if options.slaves and options.prompt_password and not options.defaults_file:
+                # Prompt once, before slaves connect concurrently
+                connection_password = getpass.getpass()
+            serve_status_file()
+        elif options.slaves:
+            if options.prompt_password and not options.defaults_file:
+                # Prompt once, before slaves connect concurrently
+                connection_password = getpass.getpass()
+            get_slaves_lag()
+        else:
+            conn = open_connection()
+            if options.discover_slaves:
+                get_slaves_lag()
+            elif options.write_heartbeat:
+                write_heartbeat()
+            elif options.watch:
+                watch_slave_lag()
+            else:
+                get_slave_lag()
+    except KeyboardInterrupt:
+        verbose("Interrupted")
     except Exception, err:
         print err
 finally:
     if conn:
         conn.close()
+    if samples_file:
+        samples_file.close()
@@ -18,12 +18,25 @@
 #
 
 import getpass
+import heapq
 import MySQLdb
+import os
+import Queue
+import random
+import re
 import sys
+import threading
 import time
 import traceback
 import warnings
+from collections import deque
 from optparse import OptionParser
+try:
+    import oakcommon
+except ImportError:
+    # As installed by the deb package, the shared module is not alongside the scripts
+    sys.path.append("/usr/share/openark-kit")
+from oakcommon import get_query_fingerprint, write_capture_header, write_capture_entry, get_capture_file_entries
 
 def parse_options():
     usage = "usage: oak-hook-general-log [options]"
@@ -37,6 +50,14 @@ def parse_options():
     parser.add_option("", "--defaults-file", dest="defaults_file", default="", help="Read from MySQL configuration file. Overrides all other options")
     parser.add_option("-t", "--timeout-minutes", dest="timeout_minutes", type="int", default=1, help="Auto disconnect after given number of minutes (default: 1)")
     parser.add_option("-s", "--sleep-time", dest="sleep_time", type="int", default=1, help="Number of seconds between log polling (default: 1)")
+    parser.add_option("", "--digest", dest="digest", action="store_true", default=False, help="Aggregate queries by fingerprint, rather than output each entry; print the top queries periodically and on exit")
+    parser.add_option("", "--digest-capacity", dest="digest_capacity", type="int", default=1000, help="Maximum number of fingerprints tracked in digest mode; heavy hitters are retained (default: 1000)")
+    parser.add_option("", "--digest-interval", dest="digest_interval", type="int", default=60, help="Number of seconds between digest reports (default: 60)")
+    parser.add_option("", "--digest-top", dest="digest_top", type="int", default=10, help="Number of top fingerprints in digest reports (default: 10)")
+    parser.add_option("", "--explain-cache-size", dest="explain_cache_size", type="int", default=1000, help="Maximum number of execution plans cached by query fingerprint (default: 1000; 0 disables caching)")
+    parser.add_option("", "--explain-cache-ttl", dest="explain_cache_ttl", type="int", default=60, help="Number of seconds an execution plan is cached for (default: 60)")
+    parser.add_option("", "--explain-threads", dest="explain_threads", type="int", default=4, help="Number of threads running EXPLAIN concurrently, each with its own connections (default: 4; 0 runs EXPLAIN on the main connection)")
+    parser.add_option("", "--explain-queue-size", dest="explain_queue_size", type="int", default=100, help="Maximum number of entries awaiting execution plans (default: 100)")
     parser.add_option("", "--filter-connection", dest="filter_connection", action="store_true", default=False, help="Only output connect/disconnect entries")
     parser.add_option("", "--filter-explain-contains", dest="filter_explain_contains", default=None, help="Only output queries whose execution plan contains given text")
     parser.add_option("", "--filter-explain-filesort", dest="filter_explain_filesort", action="store_true", default=False, help="Only output queries where execution plan indicates filesort")
@@ -49,8 +70,15 @@ def parse_options():
     parser.add_option("", "--filter-explain-temporary", dest="filter_explain_temporary", action="store_true", default=False, help="Only output queries where execution plan indicates use of temporary tables")
     parser.add_option("", "--filter-explain-total-rows-exceed", dest="filter_explain_total_rows_exceed", type="int", default=None, help="Only output queries where execution plan expects total number of rows scanned")
     parser.add_option("", "--filter-query", dest="filter_query", action="store_true", default=False, help="Only output queries")
-    parser.add_option("", "--filter-query-contains", dest="filter_query_contains", default=False, help="Only consider queries containing given text")
-    parser.add_option("", "--include-existing", dest="include_existing", action="store_true", default=False, help="Include possibly pre-existing entries in the general log table (default: disabled)")
+    parser.add_option("", "--filter-query-contains", dest="filter_query_contains", action="append", default=None, help="Only consider queries containing given text. May be given multiple times, in which case queries containing any of the texts are considered")
+    parser.add_option("", "--filter-query-regexp", dest="filter_query_regexp", default=None, help="Only consider queries matching given regular expression")
+    parser.add_option("", "--general-log-file", dest="general_log_file", default=None, help="Have the general log written to given file, and tail it, rather than poll the general_log table. File must be writable by the MySQL server and readable by this tool")
+    parser.add_option("", "--fingerprint-rate-limit", dest="fingerprint_rate_limit", type="int", default=0, help="Maximum number of queries of same fingerprint to process per second; digest counts account for the rest (default: 0, unlimited)")
+    parser.add_option("", "--input-file", dest="input_file", default=None, help="Read entries from a capture file written by --output-file, rather than hook up to a server. Use '-' for standard input")
+    parser.add_option("", "--include-existing", dest="include_existing", action="store_true", default=False, help="Include possibly pre-existing entries in the general log table or file (default: disabled)")
+    parser.add_option("", "--output-file", dest="output_file", default=None, help="Write entries to given capture file, rather than to standard output")
+    parser.add_option("", "--output-format", dest="output_format", default="json", help="Format of capture file: 'json' (JSON lines) or 'compact' (length prefixed binary) (default: json)")
+    parser.add_option("", "--sample-rate", dest="sample_rate", type="float", default=1.0, help="Fraction of entries to process, randomly sampled; digest counts are scaled accordingly (default: 1, all entries)")
     parser.add_option("-v", "--verbose", dest="verbose", action="store_true", help="Print user friendly messages")
     parser.add_option("", "--debug", dest="debug", action="store_true", help="Print stack trace on error")
     return parser.parse_args()
@@ -64,22 +92,39 @@ def print_error(message):
     sys.stderr.write("-- ERROR: %s\n" % message)
 
 def open_connection():
+    """
+    Open a connection. Any further connections reuse the password given (or prompted) for the first one.
+    """
+    global connection_password
+
     if options.defaults_file:
         conn = MySQLdb.connect(
             read_default_file = options.defaults_file)
     else:
-        if options.prompt_password:
-            password=getpass.getpass()
-        else:
-            password=options.password
+        if connection_password is None:
+            if options.prompt_password:
+                connection_password=getpass.getpass()
+            else:
+                connection_password=options.password
         conn = MySQLdb.connect(
             host = options.host,
             user = options.user,
-            passwd = password,
+            passwd = connection_password,
             port = options.port,
             unix_socket = options.socket)
     return conn;
 
+def open_unlogged_connection():
+    """
+    Open a connection whose own queries are not written to the general log, 
+    lest they be captured along with the traffic being analyzed.
+    """
+    connection = open_connection()
+    cursor = connection.cursor()
+    cursor.execute("SET @@session.sql_log_off=1")
+    cursor.close()
+    return connection
+
 def act_query(query):
     """
     Run the given query, commit changes
@@ -122,13 +167,214 @@ def get_explain_plan(query, database):
     return rows
 
 
+def get_lru_dict():
+    """
+    Return an empty dict ordered by insertion, serving as LRU. OrderedDict requires python 2.7, and is
+    imported here since it is only needed with execution plan filters.
+    """
+    from collections import OrderedDict
+    return OrderedDict()
+
+
+def lookup_explain_cache(cache_key):
+    """
+    Return (True, plan) when a fresh execution plan is cached for the given key, (False, None) otherwise.
+    Plans are only cached with execution plan filters.
+    """
+    global explain_cache_hits
+
+    if explain_cache is not None and explain_cache.has_key(cache_key):
+        cache_time, explain_plan = explain_cache.pop(cache_key)
+        if time.time() - cache_time < options.explain_cache_ttl:
+            # Re-insert as most recently used
+            explain_cache[cache_key] = (cache_time, explain_plan,)
+            explain_cache_hits += 1
+            return True, explain_plan
+    return False, None
+
+
+def store_explain_cache(cache_key, explain_plan):
+    if explain_cache is None or options.explain_cache_size <= 0:
+        return
+    explain_cache[cache_key] = (time.time(), explain_plan,)
+    while len(explain_cache) > options.explain_cache_size:
+        # Evict least recently used
+        explain_cache.popitem(last=False)
+
+
+def get_lru_cached_explain_plan(query, database):
+    """
+    Execution plans are cached by (query fingerprint, database), such that queries of same shape
+    only get to be EXPLAINed once per --explain-cache-ttl seconds.
+    """
+    cache_key = (get_query_fingerprint(query), database,)
+    found, explain_plan = lookup_explain_cache(cache_key)
+    if found:
+        return explain_plan
+
+    explain_plan = get_explain_plan(query, database)
+    store_explain_cache(cache_key, explain_plan)
+    return explain_plan
+
+
 def get_cached_explain_plan(query, database):
     global cached_explain_plan
-    if not cached_explain_plan:
-        cached_explain_plan = get_explain_plan(query, database)
+    if cached_explain_plan is None:
+        if not query.lower().strip().startswith("select"):
+            return None
+        cached_explain_plan = get_lru_cached_explain_plan(query, database)
     return cached_explain_plan
 
 
+def explain_worker():
+    """
+    Run EXPLAIN tasks off the task queue, until given None.
+    Each worker keeps its own connections, one per default database, such that no USE is
+    required per task. Up to 16 connections are kept, least recently used are closed first.
+    """
+    worker_connections = get_lru_dict()
+    try:
+        while True:
+            explain_task = explain_task_queue.get()
+            if explain_task is None:
+                return
+            database = explain_task["database"]
+            try:
+                try:
+                    if worker_connections.has_key(database):
+                        worker_connection = worker_connections.pop(database)
+                    else:
+                        worker_connection = open_unlogged_connection()
+                        # Lest metadata locks on explained tables be held, blocking DDL on them
+                        worker_connection.autocommit(True)
+                        if database:
+                            cursor = worker_connection.cursor()
+                            cursor.execute("USE %s" % database)
+                            cursor.close()
+                    worker_connections[database] = worker_connection
+                    while len(worker_connections) > 16:
+                        worker_connections.popitem(last=False)[1].close()
+
+                    cursor = worker_connection.cursor(MySQLdb.cursors.DictCursor)
+                    cursor.execute("EXPLAIN %s" % explain_task["query"])
+                    explain_task["explain_plan"] = cursor.fetchall()
+                    cursor.close()
+                except Exception, err:
+                    explain_task["error"] = err
+                    if worker_connections.has_key(database):
+                        try:
+                            worker_connections.pop(database).close()
+                        except:
+                            pass
+            finally:
+                explain_task["done"].set()
+    finally:
+        for worker_connection in worker_connections.values():
+            try:
+                worker_connection.close()
+            except:
+                pass
+
+
+def start_explain_workers():
+    global explain_task_queue
+
+    explain_task_queue = Queue.Queue(options.explain_queue_size)
+    for i in range(0, options.explain_threads):
+        explain_worker_thread = threading.Thread(target=explain_worker)
+        explain_worker_thread.setDaemon(True)
+        explain_worker_thread.start()
+        explain_workers.append(explain_worker_thread)
+    verbose("Started %d EXPLAIN threads" % len(explain_workers))
+
+
+def stop_explain_workers():
+    for explain_worker_thread in explain_workers:
+        explain_task_queue.put(None)
+    for explain_worker_thread in explain_workers:
+        explain_worker_thread.join(5)
+
+
+def explain_filters_enabled():
+    return len(explain_filters) > 0
+
+
+def should_explain_entry(entry):
+    """
+    An entry is worth explaining only when it passes all query filters (which include it being a SELECT)
+    """
+    if not explain_filters:
+        return False
+    for query_filter in query_filters:
+        if not query_filter(entry):
+            return False
+    return True
+
+
+def submit_explain_task(query, database):
+    """
+    Queue an EXPLAIN task; blocks while the queue is full
+    """
+    explain_task = {"query": query, "database": database, "done": threading.Event()}
+    while True:
+        try:
+            # A timeout keeps this interruptible by Ctrl-C
+            explain_task_queue.put(explain_task, True, 0.5)
+            return explain_task
+        except Queue.Full:
+            pass
+
+
+def get_resolved_entry(pending_entry, in_flight_explain_tasks):
+    """
+    Wait for the entry's execution plan, if any, and attach it onto the entry
+    """
+    entry, explain_task, cache_key = pending_entry
+    if explain_task is not None:
+        while not explain_task["done"].isSet():
+            explain_task["done"].wait(0.5)
+        if explain_task.has_key("error"):
+            verbose("EXPLAIN failed: %s" % explain_task["error"])
+            entry["explain_plan"] = ()
+        else:
+            entry["explain_plan"] = explain_task["explain_plan"]
+            store_explain_cache(cache_key, explain_task["explain_plan"])
+        if in_flight_explain_tasks.get(cache_key) is explain_task:
+            del in_flight_explain_tasks[cache_key]
+    return entry
+
+
+def get_entries_with_explain_plans(entries):
+    """
+    Have execution plans of SELECT entries computed concurrently by the EXPLAIN workers,
+    while yielding entries in their original order. Entries of same fingerprint share a single task.
+    """
+    pending_entries = deque()
+    in_flight_explain_tasks = {}
+    for entry in entries:
+        explain_task = None
+        cache_key = None
+        if should_explain_entry(entry):
+            cache_key = (get_query_fingerprint(entry["argument"]), entry["database"],)
+            found, explain_plan = lookup_explain_cache(cache_key)
+            if found:
+                entry["explain_plan"] = explain_plan
+            elif in_flight_explain_tasks.has_key(cache_key):
+                explain_task = in_flight_explain_tasks[cache_key]
+            else:
+                explain_task = submit_explain_task(entry["argument"], entry["database"])
+                in_flight_explain_tasks[cache_key] = explain_task
+        pending_entries.append((entry, explain_task, cache_key,))
+
+        while pending_entries:
+            head_explain_task = pending_entries[0][1]
+            if len(pending_entries) <= options.explain_queue_size and head_explain_task is not None and not head_explain_task["done"].isSet():
+                break
+            yield get_resolved_entry(pending_entries.popleft(), in_flight_explain_tasks)
+    while pending_entries:
+        yield get_resolved_entry(pending_entries.popleft(), in_flight_explain_tasks)
+
+
 def explain_plan_any_contains(query, database, search_value):
     explain_plan = get_cached_explain_plan(query, database)
     if not explain_plan:
@@ -180,18 +426,52 @@ def explain_plan_total_rows_exceed(query, database, num_rows):
     return False
 
 
-def get_processlist():
-    rows = get_rows("SHOW PROCESSLIST")
+def get_processlist(connection_ids):
+    """
+    Look up given connections only, rather than the entire PROCESSLIST
+    """
+    query = "SELECT ID, USER, HOST, DB FROM INFORMATION_SCHEMA.PROCESSLIST WHERE ID IN (%s)" % ",".join([str(int(connection_id)) for connection_id in connection_ids])
+    rows = get_rows(query)
     return rows
 
 
-def get_database_per_connection_map():
-    database_per_connection_map = {}
-    for row in get_processlist():
-        connection_id = row["Id"]
-        database = row["db"]
-        database_per_connection_map[connection_id] = database
-    return database_per_connection_map 
+def lookup_connections(connection_ids):
+    """
+    Add given, so far unknown, connections to the connection maps. Connections no longer existing are
+    mapped to no database, so that they are not looked up again.
+    The general log file, unlike the general_log table, does not list user & host per entry,
+    hence user & host are mapped as well, formatted as in the general_log table.
+    """
+    for connection_id in connection_ids:
+        database_per_connection_map[connection_id] = None
+    for row in get_processlist(connection_ids):
+        connection_id = row["ID"]
+        host = (row["HOST"] or "").split(":")[0]
+        database_per_connection_map[connection_id] = row["DB"]
+        user_host_per_connection_map[connection_id] = "%s[%s] @ %s []" % (row["USER"], row["USER"], host)
+    verbose("Looked up %d connections in PROCESSLIST" % len(connection_ids))
+
+
+def track_connection_entry(entry):
+    """
+    Keep connection maps up to date from the entries themselves: connecting, changing database
+    (either by Init DB or by a USE query) and quitting.
+    """
+    connection_id = entry["thread_id"]
+    command_type = entry["command_type"]
+    argument = entry["argument"]
+    if command_type == "Connect":
+        connect_match = connect_regexp.match(argument)
+        if connect_match:
+            user, host, database = connect_match.groups()
+            database_per_connection_map[connection_id] = database or None
+            user_host_per_connection_map[connection_id] = "%s[%s] @ %s []" % (user, user, host)
+    elif command_type == "Init DB":
+        database_per_connection_map[connection_id] = argument.strip()
+    elif command_type == "Query":
+        use_match = use_database_regexp.match(argument)
+        if use_match:
+            database_per_connection_map[connection_id] = use_match.group(1)
     
 
 def get_global_variable(variable_name):
@@ -212,14 +492,18 @@ def get_log_output():
 
 
 def get_restore_statement():
+    if options.general_log_file:
+        return "SET @@global.general_log_file='%s', @@global.general_log='%s', @@global.log_output='%s';" % (general_log_file_original_setting, general_log_original_setting, log_output_original_setting)
     return "SET @@global.general_log='%s', @@global.log_output='%s';" % (general_log_original_setting, log_output_original_setting)
 
 def store_original_log_settings():
     global general_log_original_setting
     global log_output_original_setting
+    global general_log_file_original_setting
     
     general_log_original_setting = get_global_variable("general_log")
     log_output_original_setting = get_global_variable("log_output")
+    general_log_file_original_setting = get_global_variable("general_log_file")
     verbose("Stored original settings. To recover original settings in case of a problem, issue:")
     verbose(get_restore_statement())
 
@@ -244,6 +528,105 @@ def enable_general_log_table_output():
     verbose("log_output is now %s" % get_log_output())
 
 
+def enable_general_log_file_output():
+    """
+    Have the general log written to the requested file, and make it the tail's starting point.
+    """
+    global general_log_file_offset
+    global server_id
+
+    act_query("SET @@session.sql_log_off=1")
+    act_query("SET @@global.general_log_file='%s'" % options.general_log_file.replace("'", "''"))
+    act_query("SET @@global.general_log='ON'")
+    log_output = get_log_output()
+    if log_output.find("FILE") >= 0:
+        pass
+    elif log_output.find("NONE") >= 0:
+        log_output = "FILE"
+    else:
+        log_output = "%s,FILE" % log_output
+    act_query("SET @@global.log_output = '%s'" % log_output)
+    verbose("log_output is now %s, general_log_file is %s" % (get_log_output(), get_global_variable("general_log_file")))
+
+    if not os.access(options.general_log_file, os.R_OK):
+        exit_with_error("Cannot read %s. The file must be local to this tool and readable by it" % options.general_log_file)
+    server_id = get_global_variable("server_id")
+    if options.include_existing:
+        general_log_file_offset = 0
+    else:
+        general_log_file_offset = os.path.getsize(options.general_log_file)
+    verbose("Tailing %s from offset %d" % (options.general_log_file, general_log_file_offset))
+
+
+def get_general_log_file_entry(match):
+    """
+    Turn a parsed general log file line into an entry, in the same form as a general_log table row.
+    Entries of MySQL < 5.7 only list time when it changes; otherwise the time of the previous entry applies.
+    """
+    global general_log_file_event_time
+
+    (iso_event_time, event_time, thread_id, command_type, argument) = match.groups()
+    if iso_event_time:
+        general_log_file_event_time = iso_event_time.replace("T", " ")
+    elif event_time:
+        general_log_file_event_time = time.strftime("%Y-%m-%d %H:%M:%S", time.strptime(" ".join(event_time.split()), "%y%m%d %H:%M:%S"))
+    return {
+        "event_time": general_log_file_event_time,
+        "user_host": "",
+        "thread_id": int(thread_id),
+        "server_id": server_id,
+        "command_type": command_type.strip(),
+        "argument": argument or "",
+        }
+
+
+def get_general_log_file_entries():
+    """
+    Read the general log file from where the previous read stopped, one chunk at a time, and stream the
+    parsed entries. An incomplete trailing line is kept for the next read. Since a query may span multiple
+    lines, an entry is only complete once the next entry begins, or once the file is found not to grow.
+    """
+    global general_log_file_offset
+    global general_log_file_partial_line
+    global general_log_file_pending_entry
+
+    if os.path.getsize(options.general_log_file) < general_log_file_offset:
+        verbose("%s has been truncated or replaced; reading from start" % options.general_log_file)
+        general_log_file_offset = 0
+        general_log_file_partial_line = ""
+
+    log_file = open(options.general_log_file, "rb")
+    try:
+        log_file.seek(general_log_file_offset)
+        file_has_grown = False
+        while True:
+            chunk = log_file.read(65536)
+            if not chunk:
+                break
+            file_has_grown = True
+            general_log_file_offset += len(chunk)
+            lines = (general_log_file_partial_line + chunk).split("\n")
+            general_log_file_partial_line = lines.pop()
+            for line in lines:
+                if general_log_file_banner_regexp.match(line):
+                    # Written by the server upon opening the log file
+                    continue
+                match = general_log_file_entry_regexp.match(line)
+                if match:
+                    entry = general_log_file_pending_entry
+                    general_log_file_pending_entry = get_general_log_file_entry(match)
+                    if entry:
+                        yield entry
+                elif general_log_file_pending_entry:
+                    general_log_file_pending_entry["argument"] += "\n" + line
+    finally:
+        log_file.close()
+    if not file_has_grown and not general_log_file_partial_line and general_log_file_pending_entry:
+        entry = general_log_file_pending_entry
+        general_log_file_pending_entry = None
+        yield entry
+
+
 def get_inactive_shadow_table():    
     for table in shadow_tables:  
         if table != active_shadow_table:
@@ -291,84 +674,451 @@ def truncate_slow_log_table():
     act_query(query)
     
 
-def dump_general_log_snapshot():
+def get_general_log_entries():
+    """
+    Stream the entries of the active shadow table, one at a time, via an unbuffered cursor on the
+    reader connection. Memory use does not depend on the number of entries.
+    """
+    cursor = reader_conn.cursor(MySQLdb.cursors.SSDictCursor)
+    try:
+        cursor.execute("SELECT * FROM mysql.%s" % active_shadow_table)
+        row = cursor.fetchone()
+        while row:
+            yield row
+            row = cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def get_annotated_entries(entries):
+    """
+    Annotate a batch of entries with their connection's database (and user & host, where missing).
+    Connections neither known nor connecting within the batch are looked up at once.
+    """
+    connecting_ids = set([entry["thread_id"] for entry in entries if entry["command_type"] == "Connect"])
+    unknown_ids = set([entry["thread_id"] for entry in entries if not database_per_connection_map.has_key(entry["thread_id"])])
+    unknown_ids = unknown_ids.difference(connecting_ids)
+    if unknown_ids:
+        lookup_connections(sorted(unknown_ids))
+    for entry in entries:
+        track_connection_entry(entry)
+        connection_id = entry["thread_id"]
+        entry["database"] = database_per_connection_map.get(connection_id)
+        if not entry["user_host"]:
+            entry["user_host"] = user_host_per_connection_map.get(connection_id, "")
+        if entry["command_type"] == "Quit":
+            database_per_connection_map.pop(connection_id, None)
+            user_host_per_connection_map.pop(connection_id, None)
+        yield entry
+
+
+def get_entries_with_database(entries):
+    entries_batch = []
+    for entry in entries:
+        entries_batch.append(entry)
+        if len(entries_batch) >= 100:
+            for annotated_entry in get_annotated_entries(entries_batch):
+                yield annotated_entry
+            entries_batch = []
+    for annotated_entry in get_annotated_entries(entries_batch):
+        yield annotated_entry
+
+
+def build_aho_corasick_automaton(patterns):
+    """
+    Build an Aho-Corasick automaton for given patterns: per state transitions, failure links,
+    and whether reaching the state means some pattern has been matched.
+    """
+    transitions = [{}]
+    failures = [0]
+    matches = [False]
+    for pattern in patterns:
+        state = 0
+        for char in pattern:
+            if not transitions[state].has_key(char):
+                transitions.append({})
+                failures.append(0)
+                matches.append(False)
+                transitions[state][char] = len(transitions) - 1
+            state = transitions[state][char]
+        matches[state] = True
+
+    states_queue = deque(transitions[0].values())
+    while states_queue:
+        state = states_queue.popleft()
+        for (char, next_state) in transitions[state].items():
+            states_queue.append(next_state)
+            failure = failures[state]
+            while failure and not transitions[failure].has_key(char):
+                failure = failures[failure]
+            failures[next_state] = transitions[failure].get(char, 0)
+            matches[next_state] = matches[next_state] or matches[failures[next_state]]
+    return (transitions, failures, matches,)
+
+
+def aho_corasick_contains(automaton, text):
+    """
+    Return True when text contains any of the automaton's patterns, in a single pass over the text
+    """
+    (transitions, failures, matches,) = automaton
+    state = 0
+    for char in text:
+        while state and not transitions[state].has_key(char):
+            state = failures[state]
+        state = transitions[state].get(char, 0)
+        if matches[state]:
+            return True
+    return matches[0]
+
+
+def get_query_contains_filter(texts):
+    if len(texts) == 1:
+        text = texts[0]
+        return lambda entry: text in entry["argument"]
+    if len(texts) < 32:
+        # Few substring tests are faster than a single scan by an interpreted automaton
+        def contains_any_text(entry):
+            for text in texts:
+                if text in entry["argument"]:
+                    return True
+            return False
+        return contains_any_text
+    automaton = build_aho_corasick_automaton(texts)
+    return lambda entry: aho_corasick_contains(automaton, entry["argument"])
+
+
+def get_explain_filter(explain_function, *args):
+    return lambda entry: explain_function(entry["argument"], entry["database"], *args)
+
+
+def compile_filters():
+    """
+    Compile filter options, once, into ordered lists of predicates over entries.
+    Query filters only look at the entry itself, and are ordered cheapest first.
+    Execution plan filters require an EXPLAIN, and are only evaluated for entries passing all query filters.
+    """
+    global query_filters
+    global explain_filters
+
+    explain_filters = []
+    if options.filter_explain_contains:
+        explain_filters.append(get_explain_filter(explain_plan_any_contains, options.filter_explain_contains))
+    if options.filter_explain_key:
+        # Expect either key_name or table_name.key_name
+        filter_explain_key_tokens = options.filter_explain_key.split(".")
+        if len(filter_explain_key_tokens) == 1:
+            explain_filters.append(get_explain_filter(explain_plan_contains, "key", filter_explain_key_tokens[0]))
+        elif len(filter_explain_key_tokens) == 2:
+            explain_filters.append(get_explain_filter(explain_plan_contains, "table", filter_explain_key_tokens[0]))
+            explain_filters.append(get_explain_filter(explain_plan_contains, "key", filter_explain_key_tokens[1]))
+        else:
+            exit_with_error("unrecognized filter_explain_key format")
+    if options.filter_explain_table:
+        explain_filters.append(get_explain_filter(explain_plan_contains, "table", options.filter_explain_table))
+    if options.filter_explain_fullscan:
+        explain_filters.append(get_explain_filter(explain_plan_contains, "type", "ALL"))
+    if options.filter_explain_indexscan:
+        explain_filters.append(get_explain_filter(explain_plan_contains, "type", "index"))
+    if options.filter_explain_temporary:
+        explain_filters.append(get_explain_filter(explain_plan_contains, "Extra", "Using temporary"))
+    if options.filter_explain_filesort:
+        explain_filters.append(get_explain_filter(explain_plan_contains, "Extra", "Using filesort"))
+    if options.filter_explain_fulljoin:
+        explain_filters.append(get_explain_filter(explain_plan_contains, "Extra", "Using join buffer"))
+    if options.filter_explain_rows_exceed is not None:
+        explain_filters.append(get_explain_filter(explain_plan_rows_exceed, options.filter_explain_rows_exceed))
+    if options.filter_explain_total_rows_exceed is not None:
+        explain_filters.append(get_explain_filter(explain_plan_total_rows_exceed, options.filter_explain_total_rows_exceed))
+
+    query_filters = []
+    if options.filter_connection:
+        query_filters.append(lambda entry: entry["command_type"] in ["Connect", "Quit"])
+    if options.filter_query:
+        query_filters.append(lambda entry: entry["command_type"] in ["Query", "Execute"])
+    if explain_filters:
+        # Only SELECT queries have an execution plan
+        query_filters.append(lambda entry: entry["argument"].lower().strip().startswith("select"))
+    if options.filter_query_contains:
+        query_filters.append(get_query_contains_filter(options.filter_query_contains))
+    if options.filter_query_regexp:
+        try:
+            filter_query_regexp = re.compile(options.filter_query_regexp)
+        except re.error, err:
+            exit_with_error("Invalid --filter-query-regexp: %s" % err)
+        query_filters.append(lambda entry: filter_query_regexp.search(entry["argument"]) is not None)
+    verbose("Compiled %d query filters and %d execution plan filters" % (len(query_filters), len(explain_filters)))
+
+
+def should_print_entry(entry):
     global cached_explain_plan
-    database_per_connection_map.update(get_database_per_connection_map())
-    rows = get_rows("SELECT * FROM mysql.%s" % active_shadow_table)
-    for row in rows:
-        cached_explain_plan = None
-        event_time = row["event_time"]
-        user_host = row["user_host"]
-        thread_id = row["thread_id"]
-        server_id = row["server_id"]
-        command_type = row["command_type"]
-        argument = row["argument"]
-        
-        database = None
-        if database_per_connection_map.has_key(thread_id):
-            database = database_per_connection_map[thread_id]
-
-        should_print = True
-        if options.filter_query_contains:
-            if not options.filter_query_contains in argument:
-                # We should altogether ignore this query
-                should_print = False
-
-        if options.filter_explain_contains and should_print:
-            should_print = explain_plan_any_contains(argument, database, options.filter_explain_contains)
-        if options.filter_explain_key and should_print:
-            # Expect either key_name or table_name.key_name
-            filter_explain_key_tokens = options.filter_explain_key.split(".")
-            if len(filter_explain_key_tokens) == 1:
-                should_print = explain_plan_contains(argument, database, "key", filter_explain_key_tokens[0])
-            elif len(filter_explain_key_tokens) == 2:
-                should_print = (explain_plan_contains(argument, database, "table", filter_explain_key_tokens[0]) 
-                    and explain_plan_contains(argument, database, "key", filter_explain_key_tokens[1])) 
-            else:
-                exit_with_error("unrecognized filter_explain_key format")
-        if options.filter_explain_table and should_print:
-            should_print = explain_plan_contains(argument, database, "table", options.filter_explain_table)
-        if options.filter_explain_fullscan and should_print:
-            should_print = explain_plan_contains(argument, database, "type", "ALL")
-        if options.filter_explain_indexscan and should_print:
-            should_print = explain_plan_contains(argument, database, "type", "index")
-        if options.filter_explain_temporary and should_print:
-            should_print = explain_plan_contains(argument, database, "Extra", "Using temporary")
-        if options.filter_explain_filesort and should_print:
-            should_print = explain_plan_contains(argument, database, "Extra", "Using filesort")
-        if options.filter_explain_fulljoin and should_print:
-            should_print = explain_plan_contains(argument, database, "Extra", "Using join buffer")
-        if options.filter_explain_rows_exceed is not None and should_print:
-            should_print = explain_plan_rows_exceed(argument, database, options.filter_explain_rows_exceed)
-        if options.filter_explain_total_rows_exceed is not None and should_print:
-            should_print = explain_plan_total_rows_exceed(argument, database, options.filter_explain_total_rows_exceed)
-        if options.filter_query and should_print:
-            should_print = (command_type in ["Query", "Execute"])
-        if options.filter_connection and should_print:
-            should_print = (command_type in ["Connect", "Quit"])
-            
-        if should_print:
-            print "%s\t%s\t%s\t%s\t%s\t%s" % (event_time, user_host, thread_id, server_id, command_type, argument)
-            sys.stdout.flush()
+
+    cached_explain_plan = entry.get("explain_plan")
+    for query_filter in query_filters:
+        if not query_filter(entry):
+            return False
+    for explain_filter in explain_filters:
+        if not explain_filter(entry):
+            return False
+    return True
+
+
+def get_filtered_entries(entries):
+    for entry in entries:
+        if should_print_entry(entry):
+            yield entry
+
+
+def is_rate_limited(entry):
+    """
+    Allow up to --fingerprint-rate-limit queries of same fingerprint per second (by event time).
+    Entries dropped are accounted for in the weight of the next entry of same fingerprint allowed.
+    """
+    global num_rate_limited_entries
+
+    fingerprint = get_query_fingerprint(entry["argument"])
+    event_second = str(entry["event_time"])[0:19]
+    if not fingerprint_rate_limits.has_key(fingerprint):
+        if len(fingerprint_rate_limits) >= 10000:
+            # Forget fingerprints not seen this second
+            for (stale_fingerprint, stale_rate_limit) in fingerprint_rate_limits.items():
+                if stale_rate_limit["second"] != event_second:
+                    del fingerprint_rate_limits[stale_fingerprint]
+        fingerprint_rate_limits[fingerprint] = {"second": event_second, "count": 0, "dropped": 0}
+    rate_limit = fingerprint_rate_limits[fingerprint]
+    if rate_limit["second"] != event_second:
+        rate_limit["second"] = event_second
+        rate_limit["count"] = 0
+    if rate_limit["count"] >= options.fingerprint_rate_limit:
+        rate_limit["dropped"] += 1
+        num_rate_limited_entries += 1
+        return True
+    rate_limit["count"] += 1
+    entry["weight"] = entry["weight"] * (1 + rate_limit["dropped"])
+    rate_limit["dropped"] = 0
+    return False
+
+
+def get_sampled_entries(entries):
+    """
+    Randomly sample entries by --sample-rate, then rate limit queries per fingerprint. This takes place
+    before any EXPLAIN or filtering. Each entry passed on is weighted by the number of entries it stands for.
+    """
+    global num_sampled_out_entries
+
+    for entry in entries:
+        entry["weight"] = entry.get("weight", 1.0) / options.sample_rate
+        if options.sample_rate < 1 and random.random() >= options.sample_rate:
+            num_sampled_out_entries += 1
+            continue
+        if options.fingerprint_rate_limit > 0 and entry["command_type"] in ["Query", "Execute"]:
+            if is_rate_limited(entry):
+                continue
+        yield entry
+
+
+def print_entries(entries):
+    for entry in entries:
+        print "%s\t%s\t%s\t%s\t%s\t%s" % (entry["event_time"], entry["user_host"], entry["thread_id"], entry["server_id"], entry["command_type"], entry["argument"])
+    sys.stdout.flush()
+
+
+def open_capture_file():
+    """
+    Open the --output-file capture for writing, through a 1MB buffer
+    """
+    global capture_file
+
+    capture_file = open(options.output_file, "wb", 1024*1024)
+    write_capture_header(capture_file, options.output_format)
+    verbose("Writing %s capture to %s" % (options.output_format, options.output_file))
+
+
+def get_captured_entries(entries):
+    for entry in entries:
+        write_capture_entry(capture_file, options.output_format, entry)
+        yield entry
+
+
+def output_entries(entries):
+    """
+    Write entries to the capture file, if any; aggregate them in digest mode, otherwise print them
+    """
+    if options.output_file:
+        entries = get_captured_entries(entries)
+    if options.digest:
+        digest_entries(entries)
+    elif options.output_file:
+        for entry in entries:
+            pass
+    else:
+        print_entries(entries)
+    if capture_file:
+        capture_file.flush()
+
+
+def parse_user_host(user_host):
+    """
+    Split a general log user_host value, e.g. 'root[root] @ localhost [127.0.0.1]', into (user, host)
+    """
+    user_host_tokens = user_host.split("@", 1)
+    user = user_host_tokens[0].split("[")[0].strip()
+    host = ""
+    if len(user_host_tokens) == 2:
+        host = user_host_tokens[1].split("[")[0].strip()
+    return user, host
+
+
+def increment_breakdown(breakdown, key, weight):
+    """
+    Count given key in a per-user or per-host breakdown. Breakdowns are limited to 20 keys,
+    any further keys are counted as 'other'.
+    """
+    if not breakdown.has_key(key) and len(breakdown) >= 20:
+        key = "other"
+    breakdown[key] = breakdown.get(key, 0) + weight
+
+
+def get_explain_summary(explain_plan):
+    if not explain_plan:
+        return ""
+    return ", ".join(["%s:%s:%s:%s" % (explain_row.get("table"), explain_row.get("type"), explain_row.get("key"), explain_row.get("rows")) for explain_row in explain_plan])
+
+
+def get_digest_record(fingerprint, entry):
+    """
+    Return the digest record for the given fingerprint, creating one if needed.
+    Records are bounded by --digest-capacity using the space-saving algorithm: when full, the record
+    with the lowest count is replaced, and the new record inherits that count as its possible error.
+    """
+    if digest_records.has_key(fingerprint):
+        return digest_records[fingerprint]
+
+    inherited_count = 0
+    if len(digest_records) >= options.digest_capacity:
+        # Counts only grow, hence heap entries may be stale (lower than actual): refresh and retry
+        while True:
+            heap_count, heap_fingerprint = heapq.heappop(digest_heap)
+            if not digest_records.has_key(heap_fingerprint):
+                continue
+            if digest_records[heap_fingerprint]["count"] == heap_count:
+                break
+            heapq.heappush(digest_heap, (digest_records[heap_fingerprint]["count"], heap_fingerprint,))
+        inherited_count = heap_count
+        del digest_records[heap_fingerprint]
+
+    digest_record = {
+        "fingerprint": fingerprint,
+        "count": inherited_count,
+        "error": inherited_count,
+        "first_seen": entry["event_time"],
+        "last_seen": entry["event_time"],
+        "users": {},
+        "hosts": {},
+        "explain_summary": None,
+        }
+    digest_records[fingerprint] = digest_record
+    heapq.heappush(digest_heap, (inherited_count, fingerprint,))
+    return digest_record
+
+
+def digest_entries(entries):
+    """
+    Aggregate query entries by fingerprint
+    """
+    for entry in entries:
+        if entry["command_type"] not in ["Query", "Execute"]:
+            continue
+        argument = entry["argument"]
+        digest_record = get_digest_record(get_query_fingerprint(argument), entry)
+        weight = entry.get("weight", 1)
+        digest_record["count"] += weight
+        digest_record["last_seen"] = entry["event_time"]
+        user, host = parse_user_host(entry["user_host"])
+        increment_breakdown(digest_record["users"], user, weight)
+        increment_breakdown(digest_record["hosts"], host, weight)
+        if digest_record["explain_summary"] is None:
+            explain_plan = entry.get("explain_plan")
+            if explain_plan is None and not options.input_file and argument.lower().strip().startswith("select"):
+                try:
+                    explain_plan = get_lru_cached_explain_plan(argument, entry["database"])
+                except Exception, err:
+                    explain_plan = None
+            digest_record["explain_summary"] = get_explain_summary(explain_plan)
+
+
+def get_breakdown_presentation(breakdown):
+    sorted_breakdown = sorted(breakdown.items(), key=lambda (key, count): -count)
+    return ",".join(["%s:%d" % (key, round(count)) for (key, count) in sorted_breakdown[0:3]])
+
+
+def print_digest():
+    """
+    Print the top fingerprints by count
+    """
+    top_digest_records = sorted(digest_records.values(), key=lambda digest_record: -digest_record["count"])[0:options.digest_top]
+    print "-- digest at %s: %d fingerprints tracked" % (time.strftime("%Y-%m-%d %H:%M:%S"), len(digest_records))
+    if options.sample_rate < 1 or options.fingerprint_rate_limit > 0:
+        print "-- counts are estimated: sample rate %s, per fingerprint rate limit %d/sec" % (options.sample_rate, options.fingerprint_rate_limit)
+    print "-- count\terror\tfirst_seen\tlast_seen\tusers\thosts\texplain\tfingerprint"
+    for digest_record in top_digest_records:
+        print "%d\t%d\t%s\t%s\t%s\t%s\t%s\t%s" % (round(digest_record["count"]), round(digest_record["error"]),
+            digest_record["first_seen"], digest_record["last_seen"],
+            get_breakdown_presentation(digest_record["users"]), get_breakdown_presentation(digest_record["hosts"]),
+            digest_record["explain_summary"], digest_record["fingerprint"])
+    sys.stdout.flush()
+
+
+def dump_general_log_snapshot():
+    if options.general_log_file:
+        entries = get_entries_with_database(get_general_log_file_entries())
+    else:
+        entries = get_entries_with_database(get_general_log_entries())
+    if options.sample_rate < 1 or options.fingerprint_rate_limit > 0:
+        entries = get_sampled_entries(entries)
+    if explain_workers:
+        entries = get_entries_with_explain_plans(entries)
+    output_entries(get_filtered_entries(entries))
+
+
+def read_capture_file():
+    """
+    Filter, aggregate or convert a capture offline, without touching any server
+    """
+    entries = get_capture_file_entries(options.input_file, verbose)
+    if options.sample_rate < 1 or options.fingerprint_rate_limit > 0:
+        entries = get_sampled_entries(entries)
+    output_entries(get_filtered_entries(entries))
+    if options.digest:
+        print_digest()
         
 
 def hook_general_log():
     start_time = time.time()
     store_original_log_settings()
-    enable_general_log_table_output()
-    drop_shadow_tables()
-    create_shadow_table()
+    if options.general_log_file:
+        enable_general_log_file_output()
+    else:
+        enable_general_log_table_output()
+        drop_shadow_tables()
+        create_shadow_table()
+    if explain_filters_enabled() and options.explain_threads > 0:
+        start_explain_workers()
+    last_digest_time = time.time()
     try:
         while time.time() - start_time < options.timeout_minutes*60:
             try:
-                rotate_general_log_table()
-                if not originally_used_log_tables:
-                    truncate_slow_log_table()
+                if not options.general_log_file:
+                    rotate_general_log_table()
+                    if not originally_used_log_tables:
+                        truncate_slow_log_table()
                 dump_general_log_snapshot()
             except Exception, err:
                 if options.debug:
                     traceback.print_exc()
                 print err
+            if options.digest and time.time() - last_digest_time >= options.digest_interval:
+                print_digest()
+                last_digest_time = time.time()
             time.sleep(options.sleep_time)
     except KeyboardInterrupt:
         # Catch a Ctrl-C. We still want to restore defaults, most probably disabling general log.
@@ -376,8 +1126,16 @@ def hook_general_log():
     except:
         pass
         
-    drop_shadow_tables()
+    stop_explain_workers()
+    if not options.general_log_file:
+        drop_shadow_tables()
     restore_original_log_settings()
+    if options.digest:
+        print_digest()
+    if explain_cache_hits:
+        verbose("Execution plans served from cache: %d" % explain_cache_hits)
+    if num_sampled_out_entries or num_rate_limited_entries:
+        verbose("Entries skipped: %d sampled out, %d rate limited" % (num_sampled_out_entries, num_rate_limited_entries))
 
 
 def exit_with_error(error_message):
@@ -397,12 +1155,12 @@ def exit_with_error(error_message):
 try:
     try:
         conn = None
+        reader_conn = None
+        connection_password = None
         reuse_conn = True
+        capture_file = None
         (options, args) = parse_options()
 
-        warnings.simplefilter("ignore", MySQLdb.Warning) 
-        conn = open_connection()
-        
         shadow_tables = ["general_log_shadow_0", "general_log_shadow_1"]
         active_shadow_table = shadow_tables[0]
         num_rotates = 0
@@ -411,13 +1169,73 @@ try:
         
         general_log_original_setting = None
         log_output_original_setting = None
+        general_log_file_original_setting = None
+        user_host_per_connection_map = {}
+        server_id = None
+        general_log_file_offset = 0
+        general_log_file_partial_line = ""
+        general_log_file_pending_entry = None
+        general_log_file_event_time = None
+        # General log file entries: "2016-01-01T10:00:00.123456Z\t  8 Query\tselect 1" as of 5.7,
+        # "101207 11:30:23\t  8 Query\tselect 1" or "\t\t  8 Query\tselect 1" before 5.7
+        general_log_file_entry_regexp = re.compile(r"^(?:(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?)(?:Z|[-+]\d{2}:\d{2})?|(\d{6}\s+\d{1,2}:\d{2}:\d{2})|\t)\t\s*(\d+) ([A-Z][A-Za-z ]*?)(?:\t(.*))?$")
+        general_log_file_banner_regexp = re.compile(r"^(.*, Version: .* started with:|Tcp port: .*Unix socket: .*|Time\s+Id\s+Command\s+Argument)$")
+        # Connect entries: "root@localhost on world", possibly followed by "using Socket"
+        connect_regexp = re.compile(r"^(\S*)@(\S*) on ?(\S*)")
+        use_database_regexp = re.compile(r"^\s*use\s+`?([^`;\s]+)`?\s*;?\s*$", re.I)
         cached_explain_plan = None
-        
-        hook_general_log()
+        explain_cache = None
+        explain_cache_hits = 0
+        explain_task_queue = None
+        explain_workers = []
+        digest_records = {}
+        digest_heap = []
+        query_filters = []
+        explain_filters = []
+        fingerprint_rate_limits = {}
+        num_sampled_out_entries = 0
+        num_rate_limited_entries = 0
+        compile_filters()
+        if explain_filters_enabled():
+            explain_cache = get_lru_dict()
+        if options.digest_capacity < 1:
+            exit_with_error("--digest-capacity must be positive")
+        if options.digest_interval < 1:
+            exit_with_error("--digest-interval must be positive")
+        if options.explain_threads < 0:
+            exit_with_error("--explain-threads must not be negative")
+        if options.explain_cache_size < 0:
+            exit_with_error("--explain-cache-size must not be negative")
+        if not 0 < options.sample_rate <= 1:
+            exit_with_error("--sample-rate must be greater than 0 and at most 1")
+        if options.output_format not in ["json", "compact"]:
+            exit_with_error("--output-format must be either 'json' or 'compact'")
+        if options.output_file:
+            open_capture_file()
+
+        if options.input_file:
+            if explain_filters:
+                exit_with_error("Execution plan filters cannot be used with --input-file")
+            read_capture_file()
+        else:
+            warnings.simplefilter("ignore", MySQLdb.Warning) 
+            conn = open_connection()
+            # With a log file there is no periodic table rotation to commit EXPLAINs issued on this connection
+            conn.autocommit(True)
+            # General log entries are streamed on a connection of their own, so that other queries
+            # (EXPLAIN, SHOW PROCESSLIST) can be issued on the main connection meanwhile.
+            reader_conn = open_unlogged_connection()
+            # No transaction may hold a metadata lock on a shadow table, which is later truncated or renamed
+            reader_conn.autocommit(True)
+            hook_general_log()
     except Exception, err:
         if options.debug:
             traceback.print_exc()
         print err
 finally:
+    if capture_file:
+        capture_file.close()
+    if reader_conn:
+        reader_conn.close()
     if conn:
         conn.close()
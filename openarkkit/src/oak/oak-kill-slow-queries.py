@@ -19,9 +19,18 @@
 
 import sys
 import getpass
+import re
+import threading
+import time
 import MySQLdb
 from optparse import OptionParser
 import ConfigParser
+try:
+    import oakcommon
+except ImportError:
+    # As installed by the deb package, the shared module is not alongside the scripts
+    sys.path.append("/usr/share/openark-kit")
+from oakcommon import get_query_fingerprint
 
 def parse_options():
     parser = OptionParser()
@@ -36,106 +45,579 @@ def parse_options():
     parser.add_option("-r", "--skip-root", action="store_true", dest="skip_root", default=False, help="Do not kill queries by 'root'")
     parser.add_option("-k", "--skip-user", dest="skip_user", default=None, help="Do not kill queries by by given user")
     parser.add_option("-f", "--filter-user", dest="filter_user", default=None, help="Only kill queries by by given user")
+    parser.add_option("", "--rows-examined-exceed", dest="rows_examined_exceed", type="int", default=None, help="Kill queries which examined more than given number of rows, regardless of time (requires performance_schema)")
+    parser.add_option("", "--rows-locked-exceed", dest="rows_locked_exceed", type="int", default=None, help="Kill queries whose transaction locked more than given number of rows, regardless of time (requires INNODB_TRX)")
+    parser.add_option("", "--rows-modified-exceed", dest="rows_modified_exceed", type="int", default=None, help="Kill queries whose transaction modified more than given number of rows, regardless of time (requires INNODB_TRX)")
+    parser.add_option("", "--lock-wait-seconds", dest="lock_wait_seconds", type="int", default=None, help="Kill queries waiting on a lock for more than given number of seconds (requires INNODB_TRX)")
+    parser.add_option("", "--kill-tmp-disk-tables", action="store_true", dest="kill_tmp_disk_tables", default=False, help="Kill queries which created on-disk temporary tables, regardless of time")
+    parser.add_option("", "--max-kills-per-second", dest="max_kills_per_second", type="float", default=0, help="Limit kill rate per server; excess kills are deferred to next polls, most expensive queries killed first (default: 0, unlimited)")
+    parser.add_option("", "--max-user-kills-per-second", dest="max_user_kills_per_second", type="float", default=0, help="Limit kill rate per user per server (default: 0, unlimited)")
+    parser.add_option("", "--circuit-breaker-kills", dest="circuit_breaker_kills", type="int", default=0, help="Stop killing for --circuit-breaker-seconds when more than given number of processes become due for killing within --circuit-breaker-seconds (default: 0, disabled)")
+    parser.add_option("", "--circuit-breaker-seconds", dest="circuit_breaker_seconds", type="int", default=60, help="Window over which kills are counted by circuit breaker, and time to refrain from killing once tripped (default: 60)")
+    parser.add_option("", "--rules-file", dest="rules_file", default=None, help="File of rules, each with own matching criteria, time limit and action. Processes not matching any rule are subject to --slow-query-seconds")
+    parser.add_option("-d", "--daemon", action="store_true", dest="daemon", default=False, help="Keep running, polling for slow queries every --interval-ms milliseconds")
+    parser.add_option("-i", "--interval-ms", dest="interval_ms", type="int", default=1000, help="Milliseconds between polls in daemon mode (default: 1000)")
+    parser.add_option("", "--hosts-file", dest="hosts_file", default=None, help="Fleet mode: file listing hosts (host or host:port per line) to kill slow queries on, concurrently")
+    parser.add_option("", "--timeout-seconds", dest="timeout_seconds", type="int", default=10, help="Connect timeout. In fleet mode, also time allowed per host when not in daemon mode (default: 10)")
+    parser.add_option("", "--read-timeout-seconds", dest="read_timeout_seconds", type="int", default=10, help="Time allowed for reading from or writing to a connected host, after which the connection is considered lost (default: 10)")
     parser.add_option("-v", "--verbose", dest="verbose", action="store_true", help="Print user friendly messages")
     parser.add_option("--print-only", action="store_true", dest="print_only", help="Do not execute. Only print statement")
     return parser.parse_args()
 
+def print_message(message):
+    """
+    Print a line; lines printed by concurrent hosts (fleet mode) do not interleave
+    """
+    output_lock.acquire()
+    try:
+        print message
+    finally:
+        output_lock.release()
+
 def verbose(message):
     if options.verbose:
-        print "-- %s" % message
+        print_message("-- %s" % message)
 
 def print_error(message):
-    print "-- ERROR: %s" % message
+    print_message("-- ERROR: %s" % message)
+
+def get_host_message(host_state, message):
+    """
+    In fleet mode, messages are prefixed by the host they refer to
+    """
+    if options.hosts_file:
+        return "%s: %s" % (host_state["name"], message)
+    return message
+
+def get_host_state(host, port):
+    """
+    Return the per host state: connection, processes acted upon, counters
+    """
+    return {"name": "%s:%d" % (host, port), "host": host, "port": port, "conn": None, "killed_processes": {}, "num_kills": 0, "num_errors": 0, "done": False,
+        "kill_bucket": None, "user_kill_buckets": {}, "due_processes": {}, "circuit_breaker_open_until": 0}
 
-def open_connection():
+def read_hosts_file():
+    """
+    Read the fleet's hosts: one host or host:port per line. Empty lines and # comments are ignored.
+    """
+    host_states = []
+    for line in open(options.hosts_file):
+        line = line.split("#")[0].strip()
+        if not line:
+            continue
+        host = line
+        port = options.port
+        if line.find(":") >= 0:
+            host, port = line.rsplit(":", 1)
+            port = int(port)
+        host_states.append(get_host_state(host, port))
+    return host_states
+
+def open_connection(host_state):
+    """
+    Open a connection to the given host. Reconnecting (in daemon mode) or connecting to other hosts (in fleet mode) 
+    reuses the password given (or prompted) on first connection.
+    """
+    global connection_password
+    
+    # A host which stops responding mid query raises a connection error, rather than hanging the poll
+    timeout_args = {
+        "connect_timeout": options.timeout_seconds, 
+        "read_timeout": options.read_timeout_seconds, 
+        "write_timeout": options.read_timeout_seconds,
+        }
     if options.defaults_file:
-        conn = MySQLdb.connect(read_default_file = options.defaults_file)
-    else:
-        if options.prompt_password:
-            password=getpass.getpass()
+        if options.hosts_file:
+            conn = MySQLdb.connect(read_default_file = options.defaults_file, host = host_state["host"], port = host_state["port"], **timeout_args)
         else:
-            password=options.password
+            conn = MySQLdb.connect(read_default_file = options.defaults_file, **timeout_args)
+    else:
+        if connection_password is None:
+            if options.prompt_password:
+                connection_password=getpass.getpass()
+            else:
+                connection_password=options.password
         conn = MySQLdb.connect(
-            host = options.host,
+            host = host_state["host"],
             user = options.user,
-            passwd = password,
-            port = options.port,
-            unix_socket = options.socket)
+            passwd = connection_password,
+            port = host_state["port"],
+            unix_socket = options.socket,
+            **timeout_args)
     return conn;
 
-def act_final_query(query):        
+def act_final_query(query, host_state):        
     """
     Either print or execute the given query
     """
     if options.print_only:
-        print query
+        print_message(get_host_message(host_state, query))
     else:
-        update_cursor = conn.cursor()
+        update_cursor = host_state["conn"].cursor()
         try:
             try:
                 update_cursor.execute(query)
-                verbose("Successfuly killed query")
+                verbose(get_host_message(host_state, "Successfuly killed query"))
             except:
-                print_error("error executing: %s" % query)
+                host_state["num_errors"] += 1
+                print_error(get_host_message(host_state, "error executing: %s" % query))
         finally:
             update_cursor.close()
 
-def get_slow_processes_ids():
+def get_process_fingerprint(process):
+    """
+    Compute a process' query fingerprint, at most once
+    """
+    if not process.has_key("fingerprint"):
+        process["fingerprint"] = get_query_fingerprint(process["INFO"] or "")
+    return process["fingerprint"]
+
+def get_column_matcher(column_name, value):
+    if column_name == "HOST":
+        # Process host is listed along with the client's port
+        return lambda process: (process["HOST"] or "").split(":")[0] == value
+    return lambda process: process[column_name] == value
+
+def load_rules():
+    """
+    Read rules from --rules-file. Each section is a rule, e.g.:
+        [reports]
+        user = reporter
+        query-regexp = ^SELECT .* FROM sales
+        seconds = 30
+        action = kill-query
+    A process is subject to the first rule (in order of appearance) which it matches; rules are compiled
+    into lists of matchers, cheapest first, with query fingerprint computed only when needed.
+    """
+    config = ConfigParser.RawConfigParser()
+    if not config.read(options.rules_file):
+        raise Exception("Cannot read rules file: %s" % options.rules_file)
+    
+    rules = []
+    for section in config.sections():
+        rule = dict(default_rule)
+        rule["name"] = section
+        matchers = []
+        resource_limit_keys = dict([(file_key, rule_key) for (rule_key, file_key, column_name) in resource_limits])
+        for (key, value) in config.items(section):
+            if key == "seconds":
+                rule["seconds"] = int(value)
+            elif key == "tmp-disk-tables":
+                if value.lower() in ["1", "yes", "true", "on"]:
+                    rule["tmp_disk_tables"] = 0
+                else:
+                    rule["tmp_disk_tables"] = None
+            elif resource_limit_keys.has_key(key):
+                rule[resource_limit_keys[key]] = int(value)
+            elif key == "action":
+                if value not in rule_actions:
+                    raise Exception("Rule %s: action must be one of %s" % (section, ", ".join(rule_actions)))
+                rule["action"] = value
+            elif key in ["user", "host", "db", "command", "state"]:
+                matchers.append((0, get_column_matcher(key.upper(), value),))
+            elif key == "query-regexp":
+                query_regexp = re.compile(value)
+                matchers.append((1, lambda process, query_regexp=query_regexp: query_regexp.search(process["INFO"] or "") is not None,))
+            elif key == "fingerprint":
+                fingerprint = get_query_fingerprint(value)
+                matchers.append((2, lambda process, fingerprint=fingerprint: get_process_fingerprint(process) == fingerprint,))
+            else:
+                raise Exception("Rule %s: unknown criteria %s" % (section, key))
+        matchers.sort(key=lambda (matcher_cost, matcher): matcher_cost)
+        rule["matchers"] = [matcher for (matcher_cost, matcher) in matchers]
+        rules.append(rule)
+    verbose("Loaded %d rules" % len(rules))
+    return rules
+
+def get_process_rule(process):
+    """
+    Return the first rule matched by given process, or the default (command line) rule
+    """
+    for rule in rules:
+        for matcher in rule["matchers"]:
+            if not matcher(process):
+                break
+        else:
+            return rule
+    return default_rule
+
+def get_lowest_limit(rule_key):
+    """
+    Return the lowest limit of given kind among all rules, or None when no rule sets such limit
+    """
+    limits = [rule[rule_key] for rule in rules + [default_rule] if rule[rule_key] is not None]
+    if not limits:
+        return None
+    return min(limits)
+
+def is_table_available(host_state, table_name):
+    cursor = host_state["conn"].cursor()
+    try:
+        try:
+            cursor.execute("SELECT 1 FROM %s LIMIT 0" % table_name)
+            return True
+        except MySQLdb.Error:
+            return False
+    finally:
+        cursor.close()
+
+def get_slow_processes_query(host_state):
+    """
+    Return the query (and its arguments) listing slow processes, joined with their resource consumption 
+    where required and available. Filtering takes place on the server, so that only candidate processes are transferred.
+    We will NOT kill:
+    * queries not running as long as 'slow_query_seconds', or as the shortest time of any rule, 
+      unless exceeding some resource limit
+    * idle connections, or those already killed
+    * replication threads (slave threads, binlog dumps), event scheduler, this very connection
+    """
+    columns = ["p.ID", "p.USER", "p.HOST", "p.DB", "p.COMMAND", "p.TIME", "p.STATE", "p.INFO"]
+    joins = ["INFORMATION_SCHEMA.PROCESSLIST p"]
+    candidate_conditions = ["p.TIME >= %s"]
+    candidate_query_args = [get_lowest_limit("seconds")]
+
+    trx_limits = [(rule_key, get_lowest_limit(rule_key)) for rule_key in ["rows_locked", "rows_modified", "lock_wait_seconds"]]
+    trx_limits = [(rule_key, limit) for (rule_key, limit) in trx_limits if limit is not None]
+    if trx_limits and not is_table_available(host_state, "INFORMATION_SCHEMA.INNODB_TRX"):
+        print_error(get_host_message(host_state, "INFORMATION_SCHEMA.INNODB_TRX is unavailable; ignoring rows locked, rows modified and lock wait limits"))
+        trx_limits = []
+    if trx_limits:
+        joins.append("LEFT JOIN INFORMATION_SCHEMA.INNODB_TRX trx ON (trx.trx_mysql_thread_id = p.ID)")
+        columns.extend([
+            "trx.trx_rows_locked AS ROWS_LOCKED", 
+            "trx.trx_rows_modified AS ROWS_MODIFIED", 
+            "IF(trx.trx_state = 'LOCK WAIT', TIMESTAMPDIFF(SECOND, trx.trx_wait_started, NOW()), NULL) AS LOCK_WAIT_SECONDS",
+            ])
+        trx_conditions = {
+            "rows_locked": "trx.trx_rows_locked > %s",
+            "rows_modified": "trx.trx_rows_modified > %s",
+            "lock_wait_seconds": "(trx.trx_state = 'LOCK WAIT' AND trx.trx_wait_started < NOW() - INTERVAL %s SECOND)",
+            }
+        for (rule_key, limit) in trx_limits:
+            candidate_conditions.append(trx_conditions[rule_key])
+            candidate_query_args.append(limit)
+    else:
+        columns.extend(["NULL AS ROWS_LOCKED", "NULL AS ROWS_MODIFIED", "NULL AS LOCK_WAIT_SECONDS"])
+
+    rows_examined_limit = get_lowest_limit("rows_examined")
+    tmp_disk_tables_limit = get_lowest_limit("tmp_disk_tables")
+    tmp_disk_tables_expression = "p.STATE IN ('Copying to tmp table on disk', 'converting HEAP to ondisk')"
+    if (rows_examined_limit is not None or tmp_disk_tables_limit is not None) and is_table_available(host_state, "performance_schema.events_statements_current"):
+        joins.append("LEFT JOIN performance_schema.threads t ON (t.PROCESSLIST_ID = p.ID)")
+        joins.append("LEFT JOIN performance_schema.events_statements_current stmt ON (stmt.THREAD_ID = t.THREAD_ID)")
+        columns.append("stmt.ROWS_EXAMINED AS ROWS_EXAMINED")
+        tmp_disk_tables_expression = "(stmt.CREATED_TMP_DISK_TABLES > 0 OR %s)" % tmp_disk_tables_expression
+        if rows_examined_limit is not None:
+            candidate_conditions.append("stmt.ROWS_EXAMINED > %s")
+            candidate_query_args.append(rows_examined_limit)
+    else:
+        if rows_examined_limit is not None:
+            print_error(get_host_message(host_state, "performance_schema statements are unavailable; ignoring rows examined limits"))
+        columns.append("NULL AS ROWS_EXAMINED")
+    columns.append("IF(%s, 1, 0) AS TMP_DISK_TABLES" % tmp_disk_tables_expression)
+    if tmp_disk_tables_limit is not None:
+        candidate_conditions.append(tmp_disk_tables_expression)
+
+    conditions = [
+        "(%s)" % " OR ".join(candidate_conditions),
+        "p.COMMAND NOT IN ('Sleep', 'Killed', 'Binlog Dump', 'Binlog Dump GTID', 'Daemon')",
+        "p.USER != 'system user'",
+        "p.ID != CONNECTION_ID()",
+        ]
+    query_args = candidate_query_args
+    if options.skip_root:
+        conditions.append("p.USER != 'root'")
+    if options.skip_user:
+        conditions.append("p.USER != %s")
+        query_args.append(options.skip_user)
+    if options.filter_user:
+        conditions.append("p.USER = %s")
+        query_args.append(options.filter_user)
+    query = "SELECT %s FROM %s WHERE %s" % (", ".join(columns), " ".join(joins), " AND ".join(conditions))
+    return query, query_args
+
+def get_exceeded_limit(process, rule):
+    """
+    Return a description of the first limit of the given rule which the process exceeds, or None
+    """
+    if int(process["TIME"]) >= rule["seconds"]:
+        return "time %s seconds" % process["TIME"]
+    for (rule_key, file_key, column_name) in resource_limits:
+        if rule[rule_key] is not None and process[column_name] is not None and int(process[column_name]) > rule[rule_key]:
+            return "%s %s" % (file_key, process[column_name])
+    return None
+
+def get_slow_processes(host_state):
     """
-    Return the list of process ids where queries are slow
+    Return the list of processes where queries are slow, or exceed resource limits
     """
-    slow_processes_ids = []
+    if not host_state.has_key("slow_processes_query"):
+        host_state["slow_processes_query"] = get_slow_processes_query(host_state)
+    slow_processes_query, slow_processes_query_args = host_state["slow_processes_query"]
     cursor = None;
     try:
-        cursor = conn.cursor(MySQLdb.cursors.DictCursor)
-        cursor.execute("SHOW PROCESSLIST")
-        result_set = cursor.fetchall()
-        for row in result_set:
-            time = int(row["Time"])
-            command = row["Command"]
-            user = row["User"]
-            # We will NOT kill:
-            # * queries not running as long as 'slow_query_seconds'
-            # * active queries
-            # * replication slave
-            kill_query = True
-            if time < options.slow_query_seconds:
-                kill_query = False
-            if command == "Sleep":
-                kill_query = False
-            if user == "system user":
-                kill_query = False
-            if options.skip_root and user == "root":
-                kill_query = False
-            if options.skip_user and user == options.skip_user:
-                kill_query = False
-            if options.filter_user and user != options.filter_user:
-                kill_query = False
-            if kill_query:
-                slow_processes_ids.append(row["Id"])
+        cursor = host_state["conn"].cursor(MySQLdb.cursors.DictCursor)
+        cursor.execute(slow_processes_query, slow_processes_query_args)
+        slow_processes = cursor.fetchall()
     finally:
         if cursor:
             cursor.close()
-    return slow_processes_ids
-
-def kill_slow_queries(conn):
-    slow_processes_ids = get_slow_processes_ids()
-    verbose("Found %s slow queries" % len(slow_processes_ids))
-    for process_id in slow_processes_ids:
-        cursor = conn.cursor()
-        query = "KILL QUERY %d" % process_id
+    return slow_processes
+
+def act_on_process(process, rule, exceeded_limit, host_state):
+    """
+    Apply the rule's action on given process: kill its query, kill its connection, or just log it
+    """
+    process_id = int(process["ID"])
+    if rule["action"] == "log":
+        print_message(get_host_message(host_state, "-- rule %s: process %d by %s@%s on %s running for %s seconds, exceeding %s: %s" % (rule["name"], process_id, process["USER"], process["HOST"], process["DB"], process["TIME"], exceeded_limit, process["INFO"])))
+        return
+    verbose(get_host_message(host_state, "Killing process %d, exceeding %s" % (process_id, exceeded_limit)))
+    if rule["action"] == "kill":
+        act_final_query("KILL %d" % process_id, host_state)
+    else:
+        act_final_query("KILL QUERY %d" % process_id, host_state)
+    host_state["num_kills"] += 1
+
+def get_process_cost(process):
+    """
+    Return a sort key by which processes are ordered from cheapest to most expensive: 
+    locks held (hurting other sessions) first, then rows examined, then running time
+    """
+    return (int(process["ROWS_LOCKED"] or 0), int(process["ROWS_EXAMINED"] or 0), int(process["TIME"]))
+
+def refill_token_bucket(bucket, rate, now):
+    """
+    Return the bucket, [tokens, last_refill_time], refilled at given rate, up to a burst of one second's worth 
+    (at least one token). A None bucket is created full.
+    """
+    capacity = max(rate, 1.0)
+    if bucket is None:
+        return [capacity, now]
+    bucket[0] = min(capacity, bucket[0] + (now - bucket[1])*rate)
+    bucket[1] = now
+    return bucket
+
+def acquire_kill_token(user, host_state, now):
+    """
+    Take a token from the server's bucket and from the user's bucket, only if both have one to spare.
+    Return True when the kill may proceed.
+    """
+    buckets = []
+    if options.max_kills_per_second > 0:
+        host_state["kill_bucket"] = refill_token_bucket(host_state["kill_bucket"], options.max_kills_per_second, now)
+        buckets.append(host_state["kill_bucket"])
+    if options.max_user_kills_per_second > 0:
+        user_kill_buckets = host_state["user_kill_buckets"]
+        user_kill_buckets[user] = refill_token_bucket(user_kill_buckets.get(user), options.max_user_kills_per_second, now)
+        buckets.append(user_kill_buckets[user])
+    for bucket in buckets:
+        if bucket[0] < 1:
+            return False
+    for bucket in buckets:
+        bucket[0] -= 1
+    return True
+
+def is_circuit_breaker_open(due_processes, host_state, now):
+    """
+    Track processes due for killing over the last --circuit-breaker-seconds. Trip the breaker when there are 
+    too many of them: mass killing is then more likely to cause an application retry storm than to relieve the server.
+    Return True while the breaker is open.
+    """
+    if options.circuit_breaker_kills <= 0:
+        return False
+    due_since = host_state["due_processes"]
+    for process_id in due_since.keys():
+        if due_since[process_id] < now - options.circuit_breaker_seconds:
+            del due_since[process_id]
+    for process in due_processes:
+        due_since.setdefault(int(process["ID"]), now)
+    if now < host_state["circuit_breaker_open_until"]:
+        return True
+    if len(due_since) > options.circuit_breaker_kills:
+        print_error(get_host_message(host_state, "%d processes due for killing within %d seconds; circuit breaker tripped, not killing for %d seconds" % (len(due_since), options.circuit_breaker_seconds, options.circuit_breaker_seconds)))
+        host_state["circuit_breaker_open_until"] = now + options.circuit_breaker_seconds
+        due_since.clear()
+        return True
+    return False
+
+def kill_slow_queries(host_state):
+    """
+    Kill slow queries. A query already acted upon on a previous poll, which is still winding down 
+    (e.g. rolling back), is not acted upon again.
+    Kills are subject to the rate limits and circuit breaker; most expensive queries are killed first,
+    and those exceeding the rate are left for the next polls.
+    """
+    killed_processes = host_state["killed_processes"]
+    poll_time = time.time()
+    slow_processes = list(get_slow_processes(host_state))
+    verbose(get_host_message(host_state, "Found %s slow query candidates" % len(slow_processes)))
+    slow_processes.sort(key=get_process_cost, reverse=True)
+    killed_processes_start_times = {}
+    due_processes = []
+    for process in slow_processes:
+        process_id = int(process["ID"])
+        if killed_processes_start_times.has_key(process_id):
+            # Listed more than once (e.g. nested statements)
+            continue
+        rule = get_process_rule(process)
+        if rule["action"] == "skip":
+            continue
+        exceeded_limit = get_exceeded_limit(process, rule)
+        if exceeded_limit is None:
+            continue
+        query_start_time = poll_time - int(process["TIME"])
+        if abs(killed_processes.get(process_id, 0) - query_start_time) <= 2:
+            killed_processes_start_times[process_id] = killed_processes[process_id]
+            continue
         
-        act_final_query(query)
+        if rule["action"] == "log":
+            act_on_process(process, rule, exceeded_limit, host_state)
+            killed_processes_start_times[process_id] = query_start_time
+        else:
+            due_processes.append((process, rule, exceeded_limit, query_start_time))
+
+    if is_circuit_breaker_open([process for (process, rule, exceeded_limit, query_start_time) in due_processes], host_state, poll_time):
+        if due_processes:
+            verbose(get_host_message(host_state, "Circuit breaker open; not killing %d processes" % len(due_processes)))
+        due_processes = []
+    num_deferred = 0
+    for (process, rule, exceeded_limit, query_start_time) in due_processes:
+        if not acquire_kill_token(process["USER"], host_state, poll_time):
+            num_deferred += 1
+            continue
+        act_on_process(process, rule, exceeded_limit, host_state)
+        killed_processes_start_times[int(process["ID"])] = query_start_time
+    if num_deferred:
+        verbose(get_host_message(host_state, "Kill rate exceeded; deferred %d kills" % num_deferred))
+    killed_processes.clear()
+    killed_processes.update(killed_processes_start_times)
+
+def kill_slow_queries_daemon(host_state):
+    """
+    Poll for slow queries until interrupted, over a persistent connection. Reconnect upon connection error.
+    """
+    verbose(get_host_message(host_state, "Polling every %d ms" % options.interval_ms))
+    while True:
+        try:
+            if host_state["conn"] is None:
+                host_state["conn"] = open_connection(host_state)
+            kill_slow_queries(host_state)
+        except MySQLdb.Error, err:
+            host_state["num_errors"] += 1
+            print_error(get_host_message(host_state, err))
+            try:
+                host_state["conn"].close()
+            except:
+                pass
+            host_state["conn"] = None
+        time.sleep(options.interval_ms / 1000.0)
+
+def kill_slow_queries_on_host(host_state):
+    """
+    Fleet mode: kill slow queries on a single host, once or as daemon. Runs in a thread of its own,
+    such that an unresponsive host does not hold back other hosts.
+    """
+    try:
+        try:
+            if options.daemon:
+                kill_slow_queries_daemon(host_state)
+            else:
+                host_state["conn"] = open_connection(host_state)
+                kill_slow_queries(host_state)
+        except Exception, err:
+            host_state["num_errors"] += 1
+            print_error(get_host_message(host_state, err))
+    finally:
+        if host_state["conn"]:
+            try:
+                host_state["conn"].close()
+            except:
+                pass
+        host_state["done"] = True
+
+def print_fleet_report(host_states):
+    print_message("-- host\tkills\terrors\tstatus")
+    for host_state in host_states:
+        if host_state["done"]:
+            status = "done"
+        elif options.daemon:
+            status = "running"
+        else:
+            status = "timed out"
+        print_message("%s\t%d\t%d\t%s" % (host_state["name"], host_state["num_kills"], host_state["num_errors"], status))
+
+def kill_slow_queries_fleet(host_states):
+    """
+    Kill slow queries on all hosts concurrently, each host over its own connection.
+    Not in daemon mode, each host is allowed up to --timeout-seconds to complete, after which it is reported as timed out.
+    In daemon mode, hosts are polled until interrupted.
+    """
+    verbose("Fleet of %d hosts" % len(host_states))
+    host_threads = []
+    for host_state in host_states:
+        host_thread = threading.Thread(target=kill_slow_queries_on_host, args=(host_state,))
+        host_thread.setDaemon(True)
+        host_thread.start()
+        host_threads.append(host_thread)
+    try:
+        if options.daemon:
+            while True:
+                time.sleep(1)
+        else:
+            deadline = time.time() + options.timeout_seconds
+            for host_thread in host_threads:
+                host_thread.join(max(0, deadline - time.time()))
+    finally:
+        print_fleet_report(host_states)
 
 try:
     try:
-        conn = None
+        host_state = None
+        connection_password = None
+        output_lock = threading.Lock()
         (options, args) = parse_options()
+        rule_actions = ["kill-query", "kill", "log", "skip"]
+        resource_limits = [
+            ("rows_examined", "rows-examined", "ROWS_EXAMINED"),
+            ("rows_locked", "rows-locked", "ROWS_LOCKED"),
+            ("rows_modified", "rows-modified", "ROWS_MODIFIED"),
+            ("lock_wait_seconds", "lock-wait-seconds", "LOCK_WAIT_SECONDS"),
+            ("tmp_disk_tables", "tmp-disk-tables", "TMP_DISK_TABLES"),
+            ]
+        default_rule = {
+            "name": "default", 
+            "seconds": options.slow_query_seconds, 
+            "rows_examined": options.rows_examined_exceed,
+            "rows_locked": options.rows_locked_exceed,
+            "rows_modified": options.rows_modified_exceed,
+            "lock_wait_seconds": options.lock_wait_seconds,
+            "tmp_disk_tables": None,
+            "action": "kill-query", 
+            "matchers": [],
+            }
+        if options.kill_tmp_disk_tables:
+            default_rule["tmp_disk_tables"] = 0
+        rules = []
+        if options.rules_file:
+            rules = load_rules()
 
-        conn = open_connection()
-        kill_slow_queries(conn)
+        if options.hosts_file:
+            if options.prompt_password and not options.defaults_file:
+                # Prompt once, before hosts connect concurrently
+                connection_password = getpass.getpass()
+            kill_slow_queries_fleet(read_hosts_file())
+        else:
+            host_state = get_host_state(options.host, options.port)
+            host_state["conn"] = open_connection(host_state)
+            if options.daemon:
+                kill_slow_queries_daemon(host_state)
+            else:
+                kill_slow_queries(host_state)
+    except KeyboardInterrupt:
+        verbose("Interrupted")
     except Exception, err:
         print err
 finally:
-    if conn:
-        conn.close()
+    if host_state and host_state["conn"]:
+        host_state["conn"].close()
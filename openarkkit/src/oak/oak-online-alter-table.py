@@ -17,8 +17,13 @@
 # THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import bisect
+import datetime
 import getpass
 import MySQLdb
+import os
+import tempfile
+import threading
 import time
 import re
 import sys
@@ -39,12 +44,18 @@ def parse_options():
     parser.add_option("-a", "--alter", dest="alter_statement", help="Comma delimited ALTER statement details, excluding the 'ALTER TABLE t' itself")
     parser.add_option("-c", "--chunk-size", dest="chunk_size", type="int", default=1000, help="Number of rows to act on in chunks. Default: 1000")
     parser.add_option("-l", "--lock-chunks", action="store_true", dest="lock_chunks", default=False, help="Use LOCK TABLES for each chunk")
+    parser.add_option("", "--load-data", dest="load_data", action="store_true", default=False, help="Copy chunks by exporting them to local files and loading with LOAD DATA LOCAL INFILE. Suited for large chunks")
     parser.add_option("-N", "--skip-binlog", dest="skip_binlog", action="store_true", default=False, help="Disable binary logging")
     parser.add_option("-r", "--max-lock-retries", type="int", dest="max_lock_retries", default="10", help="Maximum times to retry on deadlock or lock_wait_timeout. (default: 10; 0 is unlimited)")
     parser.add_option("--skip-delete-pass", dest="skip_delete_pass", action="store_true", default=False, help="Do not execute the DELETE data pass")
     parser.add_option("--sleep", dest="sleep_millis", type="int", default=0, help="Number of milliseconds to sleep between chunks. Default: 0")
     parser.add_option("", "--sleep-ratio", dest="sleep_ratio", type="float", default=0, help="Ratio of sleep time to execution time. Default: 0")
+    parser.add_option("", "--change-capture", dest="change_capture", default="triggers", help="How changes on the original table are propagated to the ghost table: 'triggers', 'binlog' or 'replay' (default: triggers)")
+    parser.add_option("", "--change-capture-batch-size", dest="change_capture_batch_size", type="int", default=100, help="Number of row events applied to the ghost table at once. Only applies with log based change capture. Default: 100")
+    parser.add_option("", "--replication-server-id", dest="replication_server_id", type="int", default=None, help="Server id used when reading the binary log. Only applies with --change-capture=binlog (default: derived from process id)")
+    parser.add_option("", "--replay-file", dest="replay_file", default=None, help="File of row events to apply onto the ghost table. Only applies with --change-capture=replay")
     parser.add_option("--cleanup", dest="cleanup", action="store_true", default=False, help="Remove custom triggers, ghost table from possible previous runs")
+    parser.add_option("", "--status-file", dest="status_file", default=None, help="File to which progress and ETA are written after each chunk")
     parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=True, help="Print user friendly messages")
     parser.add_option("-q", "--quiet", dest="verbose", action="store_false", help="Quiet mode, do not verbose")
     return parser.parse_args()
@@ -56,22 +67,29 @@ def verbose(message):
 def print_error(message):
     sys.stderr.write("-- ERROR: %s\n" % message)
 
-def open_connection():
+def open_connection(**connection_args):
+    """
+    Open a connection. Any further connections reuse the password given (or prompted) for the first one.
+    """
+    global connection_password
+
     verbose("Connecting to MySQL")
     if options.defaults_file:
-        conn = MySQLdb.connect(read_default_file = options.defaults_file)
+        conn = MySQLdb.connect(read_default_file = options.defaults_file, **connection_args)
     else:
-        if options.prompt_password:
-            password=getpass.getpass()
-        else:
-            password=options.password
+        if connection_password is None:
+            if options.prompt_password:
+                connection_password=getpass.getpass()
+            else:
+                connection_password=options.password
         conn = MySQLdb.connect(
             host = options.host,
             user = options.user,
-            passwd = password,
+            passwd = connection_password,
             port = options.port,
             db = database_name,
-            unix_socket = options.socket)
+            unix_socket = options.socket,
+            **connection_args)
     return conn;
 
 
@@ -117,61 +135,147 @@ def get_session_variable_value(session_variable_name):
     return session_variable_value
 
 
+def get_table_names_listing(table_names):
+    return ", ".join(["'%s'" % table_name for table_name in table_names])
+
+
+def forget_catalog_table(table_name):
+    """
+    Remove any metadata for the given table from the in-memory catalog
+    """
+    table_key = table_name.lower()
+    for catalog_section in ["tables", "columns", "statistics", "triggers"]:
+        if catalog[catalog_section].has_key(table_key):
+            del catalog[catalog_section][table_key]
+    catalog["foreign_keys"] = [row for row in catalog["foreign_keys"]
+        if row["TABLE_NAME"].lower() != table_key and row["REFERENCED_TABLE_NAME"].lower() != table_key]
+
+
+def move_catalog_table(from_table_name, to_table_name):
+    """
+    Reflect a RENAME TABLE in the in-memory catalog
+    """
+    from_table_key = from_table_name.lower()
+    to_table_key = to_table_name.lower()
+    for catalog_section in ["tables", "columns", "statistics", "triggers"]:
+        if catalog[catalog_section].has_key(from_table_key):
+            catalog[catalog_section][to_table_key] = catalog[catalog_section][from_table_key]
+            del catalog[catalog_section][from_table_key]
+
+
+def load_catalog(table_names):
+    """
+    Read all metadata this utility needs for the given tables off INFORMATION_SCHEMA, in bulk,
+    onto the in-memory catalog. Any previously loaded metadata for these tables is replaced.
+    Tables this utility creates, alters or drops are later on maintained in the catalog
+    without going back to INFORMATION_SCHEMA.
+    """
+    table_names = [table_name for table_name in table_names if table_name]
+    for table_name in table_names:
+        forget_catalog_table(table_name)
+    table_names_listing = get_table_names_listing(table_names)
+
+    query = """
+        SELECT TABLE_NAME, ENGINE
+        FROM INFORMATION_SCHEMA.TABLES
+        WHERE TABLE_SCHEMA='%s'
+            AND TABLE_NAME IN (%s)
+        """ % (database_name, table_names_listing)
+    for row in get_rows(query):
+        catalog["tables"][row["TABLE_NAME"].lower()] = row
+
+    query = """
+        SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE, CHARACTER_SET_NAME
+        FROM INFORMATION_SCHEMA.COLUMNS
+        WHERE TABLE_SCHEMA='%s'
+            AND TABLE_NAME IN (%s)
+        ORDER BY TABLE_NAME, ORDINAL_POSITION
+        """ % (database_name, table_names_listing)
+    for row in get_rows(query):
+        catalog["columns"].setdefault(row["TABLE_NAME"].lower(), []).append(row)
+
+    query = """
+        SELECT TABLE_NAME, INDEX_NAME, NON_UNIQUE, COLUMN_NAME
+        FROM INFORMATION_SCHEMA.STATISTICS
+        WHERE TABLE_SCHEMA='%s'
+            AND TABLE_NAME IN (%s)
+        ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX
+        """ % (database_name, table_names_listing)
+    for row in get_rows(query):
+        catalog["statistics"].setdefault(row["TABLE_NAME"].lower(), []).append(row)
+
+    query = """
+        SELECT EVENT_OBJECT_TABLE, TRIGGER_NAME, ACTION_TIMING
+        FROM INFORMATION_SCHEMA.TRIGGERS
+        WHERE TRIGGER_SCHEMA='%s'
+            AND EVENT_OBJECT_TABLE IN (%s)
+        """ % (database_name, table_names_listing)
+    for row in get_rows(query):
+        catalog["triggers"].setdefault(row["EVENT_OBJECT_TABLE"].lower(), []).append(row)
+
+    query = """
+        SELECT TABLE_NAME, REFERENCED_TABLE_NAME
+        FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE
+        WHERE
+            REFERENCED_TABLE_NAME IS NOT NULL
+            AND ((TABLE_SCHEMA='%s' AND TABLE_NAME IN (%s))
+              OR (REFERENCED_TABLE_SCHEMA='%s' AND REFERENCED_TABLE_NAME IN (%s))
+            )
+        """ % (database_name, table_names_listing,
+               database_name, table_names_listing)
+    catalog["foreign_keys"].extend(get_rows(query))
+    verbose("Read metadata for %s" % ", ".join(["%s.%s" % (database_name, table_name) for table_name in table_names]))
+
+
+def get_catalog_columns(table_name):
+    return catalog["columns"].get(table_name.lower(), [])
+
+
+def get_catalog_triggers(table_name):
+    return catalog["triggers"].get(table_name.lower(), [])
+
+
 def get_possible_unique_key_columns(read_table_name):
     """
     Return the columns with unique keys which are acceptable by this utility
     """
     verbose("Checking for UNIQUE columns on %s.%s, by which to chunk" % (database_name, read_table_name))
-    query = """
-        SELECT
-          COLUMNS.TABLE_SCHEMA,
-          COLUMNS.TABLE_NAME,
-          COLUMNS.COLUMN_NAME,
-          UNIQUES.INDEX_NAME,
-          UNIQUES.COLUMN_NAMES,
-          UNIQUES.COUNT_COLUMN_IN_INDEX,
-          COLUMNS.DATA_TYPE,
-          COLUMNS.CHARACTER_SET_NAME
-        FROM INFORMATION_SCHEMA.COLUMNS INNER JOIN (
-          SELECT
-            TABLE_SCHEMA,
-            TABLE_NAME,
-            INDEX_NAME,
-            COUNT(*) AS COUNT_COLUMN_IN_INDEX,
-            GROUP_CONCAT(COLUMN_NAME ORDER BY SEQ_IN_INDEX ASC) AS COLUMN_NAMES,
-            SUBSTRING_INDEX(GROUP_CONCAT(COLUMN_NAME ORDER BY SEQ_IN_INDEX ASC), ',', 1) AS FIRST_COLUMN_NAME
-          FROM INFORMATION_SCHEMA.STATISTICS
-          WHERE NON_UNIQUE=0
-          GROUP BY TABLE_SCHEMA, TABLE_NAME, INDEX_NAME
-        ) AS UNIQUES
-        ON (
-          COLUMNS.TABLE_SCHEMA = UNIQUES.TABLE_SCHEMA AND
-          COLUMNS.TABLE_NAME = UNIQUES.TABLE_NAME AND
-          COLUMNS.COLUMN_NAME = UNIQUES.FIRST_COLUMN_NAME
-        )
-        WHERE
-          COLUMNS.TABLE_SCHEMA = '%s'
-          AND COLUMNS.TABLE_NAME = '%s'
-        ORDER BY
-          COLUMNS.TABLE_SCHEMA, COLUMNS.TABLE_NAME,
-          CASE UNIQUES.INDEX_NAME
-            WHEN 'PRIMARY' THEN 0
-            ELSE 1
-          END,
-          CASE IFNULL(CHARACTER_SET_NAME, '')
-              WHEN '' THEN 0
-              ELSE 1
-          END,
-          CASE DATA_TYPE
-            WHEN 'tinyint' THEN 0
-            WHEN 'smallint' THEN 1
-            WHEN 'int' THEN 2
-            WHEN 'bigint' THEN 3
-            ELSE 100
-          END,
-          COUNT_COLUMN_IN_INDEX
-        """ % (database_name, read_table_name)
-    rows = get_rows(query)
+    columns_by_name = {}
+    for column in get_catalog_columns(read_table_name):
+        columns_by_name[column["COLUMN_NAME"].lower()] = column
+
+    unique_keys_column_names = {}
+    unique_keys_names = []
+    for row in catalog["statistics"].get(read_table_name.lower(), []):
+        if int(row["NON_UNIQUE"]) == 0:
+            if not unique_keys_column_names.has_key(row["INDEX_NAME"]):
+                unique_keys_column_names[row["INDEX_NAME"]] = []
+                unique_keys_names.append(row["INDEX_NAME"])
+            unique_keys_column_names[row["INDEX_NAME"]].append(row["COLUMN_NAME"])
+
+    data_type_ranks = {"tinyint": 0, "smallint": 1, "int": 2, "bigint": 3}
+    ranked_rows = []
+    for index_name in unique_keys_names:
+        column_names = unique_keys_column_names[index_name]
+        first_column = columns_by_name.get(column_names[0].lower())
+        if first_column is None:
+            continue
+        row = {
+            "TABLE_SCHEMA": database_name,
+            "TABLE_NAME": read_table_name,
+            "COLUMN_NAME": first_column["COLUMN_NAME"],
+            "INDEX_NAME": index_name,
+            "COLUMN_NAMES": ",".join(column_names),
+            "COUNT_COLUMN_IN_INDEX": len(column_names),
+            "DATA_TYPE": first_column["DATA_TYPE"],
+            "CHARACTER_SET_NAME": first_column["CHARACTER_SET_NAME"],
+            }
+        # PRIMARY first, then non textual, then smaller integers, then fewer columns
+        rank = (index_name != "PRIMARY", bool(first_column["CHARACTER_SET_NAME"]),
+            data_type_ranks.get(first_column["DATA_TYPE"].lower(), 100), len(column_names))
+        ranked_rows.append((rank, len(ranked_rows), row,))
+    ranked_rows.sort()
+    rows = [row for (rank, position, row) in ranked_rows]
     return rows
 
 
@@ -232,16 +336,9 @@ def get_table_engine():
     """
     engine = None
 
-    query = """
-        SELECT ENGINE
-        FROM INFORMATION_SCHEMA.TABLES
-        WHERE TABLE_SCHEMA='%s'
-            AND TABLE_NAME='%s'
-        """ % (database_name, original_table_name)
-
-    row = get_row(query)
-    if row:
-        engine = row['ENGINE'].lower()
+    table = catalog["tables"].get(original_table_name.lower())
+    if table and table["ENGINE"]:
+        engine = table["ENGINE"].lower()
         verbose("Table %s.%s is of engine %s" % (database_name, original_table_name, engine))
 
     return engine
@@ -252,41 +349,20 @@ def validate_no_after_triggers_exist():
     No 'AFTER' triggers allowed on table, since this utility creates all three AFTER
     triggers (INSERT, UPDATE, DELETE)
     """
+    after_triggers = [trigger for trigger in get_catalog_triggers(original_table_name) if trigger["ACTION_TIMING"] == "AFTER"]
 
-    query = """
-        SELECT COUNT(*) AS count
-        FROM INFORMATION_SCHEMA.TRIGGERS
-        WHERE TRIGGER_SCHEMA='%s'
-            AND EVENT_OBJECT_TABLE='%s'
-            AND ACTION_TIMING='AFTER'
-        """ % (database_name, original_table_name)
-
-    row = get_row(query)
-    count = int(row['count'])
-
-    return count == 0
+    return len(after_triggers) == 0
 
 
 def validate_no_foreign_keys_exist():
     """
     At the moment, no foreign keys are allowed
     """
+    original_table_key = original_table_name.lower()
+    foreign_keys = [row for row in catalog["foreign_keys"]
+        if row["TABLE_NAME"].lower() == original_table_key or row["REFERENCED_TABLE_NAME"].lower() == original_table_key]
 
-    query = """
-        SELECT COUNT(*) AS count
-        FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE
-        WHERE
-            REFERENCED_TABLE_NAME IS NOT NULL
-            AND ((TABLE_SCHEMA='%s' AND TABLE_NAME='%s')
-              OR (REFERENCED_TABLE_SCHEMA='%s' AND REFERENCED_TABLE_NAME='%s')
-            )
-        """ % (database_name, original_table_name,
-               database_name, original_table_name)
-
-    row = get_row(query)
-    count = int(row['count'])
-
-    return count == 0
+    return len(foreign_keys) == 0
 
 
 def table_exists(check_table_name):
@@ -296,19 +372,7 @@ def table_exists(check_table_name):
     if not check_table_name:
         return 0
 
-    count = 0
-
-    query = """
-        SELECT COUNT(*) AS count
-        FROM INFORMATION_SCHEMA.TABLES
-        WHERE TABLE_SCHEMA='%s'
-            AND TABLE_NAME='%s'
-        """ % (database_name, check_table_name)
-
-    row = get_row(query)
-    count = int(row['count'])
-
-    return count
+    return catalog["tables"].has_key(check_table_name.lower())
 
 
 def drop_table(drop_table_name):
@@ -320,6 +384,7 @@ def drop_table(drop_table_name):
     if table_exists(drop_table_name):
         query = "DROP TABLE IF EXISTS %s.%s" % (database_name, drop_table_name)
         act_query(query)
+        forget_catalog_table(drop_table_name)
         verbose("Table %s.%s was found and dropped" % (database_name, drop_table_name))
 
 
@@ -353,14 +418,7 @@ def get_table_columns(read_table_name):
     """
     Return the list of column names (lowercase) for the given table
     """
-    query = """
-        SELECT COLUMN_NAME
-        FROM INFORMATION_SCHEMA.COLUMNS
-        WHERE TABLE_SCHEMA='%s'
-            AND TABLE_NAME='%s'
-        ORDER BY ORDINAL_POSITION
-        """ % (database_name, read_table_name)
-    column_names = set([row["COLUMN_NAME"].lower() for row in get_rows(query)])
+    column_names = set([row["COLUMN_NAME"].lower() for row in get_catalog_columns(read_table_name)])
 
     return column_names
 
@@ -427,6 +485,7 @@ def create_custom_triggers():
         """ % (database_name, after_delete_trigger_name, database_name, original_table_name,
                database_name, ghost_table_name, unique_key_column_names, unique_key_column_names_old)
     act_query(query)
+    add_catalog_custom_trigger(after_delete_trigger_name)
     verbose("Created AD trigger")
 
     shared_columns_listing = ", ".join(["`%s`" % shared_column for shared_column in shared_columns])
@@ -446,6 +505,7 @@ def create_custom_triggers():
                database_name, ghost_table_name, unique_key_column_names, unique_key_column_names_old,
                database_name, ghost_table_name, shared_columns_listing, shared_columns_new_listing)
     act_query(query)
+    add_catalog_custom_trigger(after_update_trigger_name)
     verbose("Created AU trigger")
 
     query = """
@@ -455,6 +515,7 @@ def create_custom_triggers():
         """ % (database_name, after_insert_trigger_name, database_name, original_table_name,
                database_name, ghost_table_name, shared_columns_listing, shared_columns_new_listing)
     act_query(query)
+    add_catalog_custom_trigger(after_insert_trigger_name)
     verbose("Created AI trigger")
 
 
@@ -462,19 +523,14 @@ def trigger_exists(trigger_name):
     """
     See if the given trigger exists on the original table
     """
+    matching_triggers = [trigger for trigger in get_catalog_triggers(original_table_name) if trigger["TRIGGER_NAME"].lower() == trigger_name.lower()]
 
-    query = """
-        SELECT COUNT(*) AS count
-        FROM INFORMATION_SCHEMA.TRIGGERS
-        WHERE TRIGGER_SCHEMA='%s'
-            AND EVENT_OBJECT_TABLE='%s'
-            AND TRIGGER_NAME='%s'
-        """ % (database_name, original_table_name, trigger_name)
+    return len(matching_triggers)
 
-    row = get_row(query)
-    count = int(row['count'])
 
-    return count
+def add_catalog_custom_trigger(trigger_name):
+    catalog["triggers"].setdefault(original_table_name.lower(), []).append(
+        {"EVENT_OBJECT_TABLE": original_table_name, "TRIGGER_NAME": trigger_name, "ACTION_TIMING": "AFTER"})
 
 
 def drop_custom_trigger(trigger_name):
@@ -485,6 +541,7 @@ def drop_custom_trigger(trigger_name):
             DROP TRIGGER IF EXISTS %s.%s
             """ % (database_name, trigger_name)
         act_query(query)
+        catalog["triggers"][original_table_name.lower()] = [trigger for trigger in get_catalog_triggers(original_table_name) if trigger["TRIGGER_NAME"].lower() != trigger_name.lower()]
         verbose("Dropped custom trigger %s" % trigger_name)
 
 
@@ -497,6 +554,242 @@ def drop_custom_triggers():
     drop_custom_trigger(after_insert_trigger_name)
 
 
+def get_master_position():
+    """
+    Return the current (log file, log position) of the server's binary log
+    """
+    row = get_row("SHOW MASTER STATUS")
+    if not row:
+        return None
+    return (row["File"], int(row["Position"]),)
+
+
+def get_no_position():
+    return None
+
+
+def validate_row_based_binary_logging():
+    """
+    Binary log based change capture requires full row images to be logged
+    """
+    row = get_row("SHOW GLOBAL VARIABLES LIKE 'binlog_format'")
+    if not row or row["Value"].upper() != "ROW":
+        return False
+    row = get_row("SHOW GLOBAL VARIABLES LIKE 'binlog_row_image'")
+    if row and row["Value"].upper() != "FULL":
+        return False
+    return True
+
+
+def validate_rename_under_lock_supported():
+    """
+    Log based change capture swaps the tables while they are WRITE locked. RENAME TABLE on locked
+    tables is only allowed as of MySQL 8.0.13.
+    """
+    version = get_row("SELECT VERSION() AS version")["version"]
+    version_match = re.match(r"^(\d+)\.(\d+)\.(\d+)", version)
+    if not version_match or version.lower().find("mariadb") >= 0:
+        return False
+    return tuple([int(token) for token in version_match.groups()]) >= (8, 0, 13)
+
+
+def get_lowercase_keys_dict(values):
+    if values is None:
+        return None
+    lowercase_keys_dict = {}
+    for key in values:
+        lowercase_keys_dict[key.lower()] = values[key]
+    return lowercase_keys_dict
+
+
+def get_binlog_row_events(stream, write_rows_event_type, update_rows_event_type):
+    """
+    Generate (position, action, before_values, after_values) row events off the binary log stream.
+    Generates None whenever the stream is caught up with the server.
+    """
+    try:
+        while True:
+            for binlog_event in stream:
+                position = (stream.log_file, stream.log_pos,)
+                for row in binlog_event.rows:
+                    if isinstance(binlog_event, write_rows_event_type):
+                        yield (position, "insert", None, get_lowercase_keys_dict(row["values"]),)
+                    elif isinstance(binlog_event, update_rows_event_type):
+                        yield (position, "update", get_lowercase_keys_dict(row["before_values"]), get_lowercase_keys_dict(row["after_values"]),)
+                    else:
+                        yield (position, "delete", get_lowercase_keys_dict(row["values"]), None,)
+            yield None
+    finally:
+        stream.close()
+
+
+def open_binlog_event_source(start_position):
+    """
+    Read the original table's row events from the server's binary log, starting at given position.
+    """
+    try:
+        from pymysqlreplication import BinLogStreamReader
+        from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
+    except ImportError:
+        exit_with_error("python-mysql-replication must be installed in order to use --change-capture=binlog")
+
+    if start_position is None:
+        exit_with_error("Cannot read binary log position. Is binary logging enabled?")
+
+    if options.defaults_file:
+        connection_settings = {"read_default_file": options.defaults_file}
+    else:
+        connection_settings = {"host": options.host, "user": options.user, "passwd": connection_password, "port": options.port}
+        if options.host == "localhost":
+            connection_settings["unix_socket"] = options.socket
+    replication_server_id = options.replication_server_id
+    if replication_server_id is None:
+        replication_server_id = 1000000 + os.getpid()
+
+    stream = BinLogStreamReader(
+        connection_settings = connection_settings,
+        server_id = replication_server_id,
+        log_file = start_position[0],
+        log_pos = start_position[1],
+        resume_stream = True,
+        blocking = False,
+        only_events = [WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent],
+        only_schemas = [database_name],
+        only_tables = [original_table_name])
+    verbose("Reading binary log from %s:%d" % start_position)
+    return get_binlog_row_events(stream, WriteRowsEvent, UpdateRowsEvent)
+
+
+def get_replay_row_events(replay_file, json_module):
+    """
+    Generate (position, action, before_values, after_values) row events off the replay file.
+    Generates None whenever the end of file is reached; lines appended later on are picked up.
+    """
+    line_number = 0
+    try:
+        while True:
+            offset = replay_file.tell()
+            line = replay_file.readline()
+            if not line.endswith("\n"):
+                # End of file, or a line not yet completely written
+                replay_file.seek(offset)
+                yield None
+                continue
+            line_number += 1
+            if not line.strip():
+                continue
+            replay_event = json_module.loads(line)
+            yield ((options.replay_file, line_number,), replay_event["action"].lower(),
+                   get_lowercase_keys_dict(replay_event.get("before")), get_lowercase_keys_dict(replay_event.get("after")),)
+    finally:
+        replay_file.close()
+
+
+def open_replay_event_source(start_position):
+    """
+    Read row events from a file, one JSON object per line, in the form:
+    {"action": "insert"|"update"|"delete", "before": {column: value, ...}, "after": {column: value, ...}}
+    This stands in for the binary log when testing.
+    """
+    import json
+
+    replay_file = open(options.replay_file)
+    verbose("Reading row events from %s" % options.replay_file)
+    return get_replay_row_events(replay_file, json)
+
+
+def open_change_capture_source():
+    """
+    Open the row event source for the chosen change capture method, starting at the current position
+    """
+    open_event_source, get_position = change_capture_backends[options.change_capture]
+    return open_event_source(get_position())
+
+
+def get_change_event_operations(change_event):
+    """
+    Translate a row event into ordered operations on the ghost table:
+    ("delete", unique key values) and ("replace", shared columns values).
+    An update is a delete followed by a replace, since the unique key itself may have changed.
+    """
+    position, action, before_values, after_values = change_event
+    operations = []
+    if action in ["update", "delete"]:
+        operations.append(("delete", [before_values[column_name] for column_name in unique_key_column_names_list],))
+    if action in ["insert", "update"]:
+        operations.append(("replace", [after_values[column_name] for column_name in shared_columns],))
+    return operations
+
+
+def get_change_operations_queries(operations):
+    """
+    Return (query, query_args) pairs for the given operations, in order.
+    Consecutive operations of the same type are merged into a single statement.
+    """
+    shared_columns_listing = ", ".join(["`%s`" % shared_column for shared_column in shared_columns])
+    shared_columns_placeholders = "(%s)" % ", ".join(["%s"] * len(shared_columns))
+    unique_key_equality = get_multiple_columns_equality(unique_key_column_names_list, ["%s"] * count_columns_in_unique_key)
+
+    queries = []
+    i = 0
+    while i < len(operations):
+        operation_type = operations[i][0]
+        j = i
+        while j < len(operations) and operations[j][0] == operation_type:
+            j += 1
+        values_list = [values for (operation, values) in operations[i:j]]
+        query_args = [value for values in values_list for value in values]
+        if operation_type == "delete":
+            query = "DELETE FROM %s.%s WHERE %s" % (database_name, ghost_table_name,
+                " OR ".join([unique_key_equality] * len(values_list)))
+        else:
+            query = "REPLACE INTO %s.%s (%s) VALUES %s" % (database_name, ghost_table_name,
+                shared_columns_listing, ", ".join([shared_columns_placeholders] * len(values_list)))
+        queries.append((query, query_args,))
+        i = j
+    return queries
+
+
+def apply_change_events(change_events):
+    """
+    Apply a batch of row events onto the ghost table, in a single transaction
+    """
+    operations = []
+    for change_event in change_events:
+        operations.extend(get_change_event_operations(change_event))
+
+    cursor = conn.cursor()
+    for (query, query_args) in get_change_operations_queries(operations):
+        cursor.execute(query, query_args)
+    cursor.close()
+    conn.commit()
+
+
+def apply_pending_change_events():
+    """
+    Apply row events from the change capture source onto the ghost table, in batches,
+    until the source is caught up. Called while the original table is locked, this applies
+    all changes made to it; events are never cut short mid way through a multi row event.
+    """
+    num_applied_events = 0
+    change_events = []
+    while True:
+        change_event = change_capture_source.next()
+        if change_event is None:
+            break
+        change_events.append(change_event)
+        if len(change_events) >= options.change_capture_batch_size:
+            apply_change_events(change_events)
+            num_applied_events += len(change_events)
+            change_events = []
+    if change_events:
+        apply_change_events(change_events)
+        num_applied_events += len(change_events)
+    if num_applied_events:
+        verbose("+ Applied %d row events onto %s.%s" % (num_applied_events, database_name, ghost_table_name))
+    return num_applied_events
+
+
 def get_unique_key_min_values_variables():
     return ",".join(["@unique_key_min_value_%d" % i for i in range(0,count_columns_in_unique_key)])
 
@@ -695,6 +988,8 @@ def get_eta_seconds(elapsed_times, ratio_complete):
 def get_eta_presentation(eta_seconds, data_valid):
     if not data_valid:
         return "N/A"
+    if eta_seconds < 0:
+        eta_seconds = 0
     eta_seconds = round(eta_seconds+0.5)
     hours = eta_seconds / (60*60)
     minutes = (eta_seconds / 60) % 60
@@ -702,13 +997,135 @@ def get_eta_presentation(eta_seconds, data_valid):
     return "%02d:%02d:%02d" % (hours, minutes, seconds)
 
 
-def get_progress_and_eta_presentation(elapsed_times, elapsed_time, ratio_complete):
+def get_progress_and_eta(elapsed_times, elapsed_time, ratio_complete):
+    """
+    Return progress percent, ETA seconds and whether the ETA is based on enough data
+    """
     elapsed_times.append((elapsed_time, ratio_complete,))
-    elapsed_times = elapsed_times[-5:]
+    del elapsed_times[:-5]
     progress = int(100.0 * ratio_complete)
-    #eta_seconds = get_eta_seconds(elapsed_times, ratio_complete)
-    #return "progress: %d%%, ETA: %s" % (progress, get_eta_presentation(eta_seconds, len(elapsed_times) >= 5))
-    return "progress: %d%%" % progress
+    eta_seconds = get_eta_seconds(elapsed_times, ratio_complete)
+    return progress, eta_seconds, len(elapsed_times) >= 5
+
+
+def get_progress_and_eta_presentation(progress, eta_seconds, eta_valid):
+    return "progress: %d%%, ETA: %s" % (progress, get_eta_presentation(eta_seconds, eta_valid))
+
+
+def get_estimated_rows_count(condition):
+    """
+    Estimate the number of rows in the original table answering the given condition on the
+    unique key. This relies on the optimizer's index dives, and does not scan the rows.
+    """
+    query = """
+        EXPLAIN SELECT %s FROM %s.%s FORCE INDEX (%s)
+        WHERE %s
+        """ % (unique_key_column_names, database_name, original_table_name, original_table_unique_key_name, condition)
+    estimated_rows_count = 0
+    for row in get_rows(query):
+        if row["rows"]:
+            estimated_rows_count += int(row["rows"])
+    return estimated_rows_count
+
+
+def get_estimated_total_rows_count():
+    """
+    Estimate the number of rows within the unique key's (min, max) range
+    """
+    return get_estimated_rows_count("%s AND %s" % (
+        get_multiple_columns_non_equality_comparison_by_names(unique_key_column_names, get_unique_key_min_values_variables(), ">", True),
+        get_multiple_columns_non_equality_comparison_by_names(unique_key_column_names, get_unique_key_max_values_variables(), "<", True)))
+
+
+def get_estimated_ratio_complete(estimated_total_rows_count):
+    """
+    Estimate the ratio of rows preceding the current range start, based on index row estimates.
+    Applies to any type of key.
+    """
+    if not estimated_total_rows_count:
+        return 0
+    estimated_rows_count = get_estimated_rows_count(get_multiple_columns_non_equality_comparison_by_names(
+        unique_key_column_names, get_unique_key_range_start_variables(), "<"))
+    return min(1.0, float(estimated_rows_count) / estimated_total_rows_count)
+
+
+def build_unique_key_histogram():
+    """
+    Build an equi-depth histogram on the first column of an integer unique key, by sampling the
+    optimizer's row estimates off the index (no rows are scanned). Starting with the (min, max) range,
+    buckets are bisected until each holds roughly 1% of the rows or less, bounded by 1000 samples.
+    Returns a sorted list of (key value, estimated number of rows with lower key values).
+    """
+    num_buckets = 100
+    max_num_samples = 1000
+
+    def get_estimated_rows_below(value):
+        return get_estimated_rows_count("%s < %d" % (unique_key_column_names_list[0], value))
+
+    min_value = int(unique_key_min_values[0])
+    max_value = int(unique_key_max_values[0]) + 1
+    estimated_rows_below = {min_value: 0, max_value: get_estimated_rows_below(max_value)}
+    bucket_max_rows = max(1, estimated_rows_below[max_value] / num_buckets)
+
+    pending_buckets = [(min_value, max_value,)]
+    num_samples = 0
+    while pending_buckets and num_samples < max_num_samples:
+        low_value, high_value = pending_buckets.pop(0)
+        if high_value - low_value <= 1:
+            continue
+        if estimated_rows_below[high_value] - estimated_rows_below[low_value] <= bucket_max_rows:
+            continue
+        middle_value = low_value + (high_value - low_value) / 2
+        estimated_rows_below[middle_value] = get_estimated_rows_below(middle_value)
+        num_samples += 1
+        pending_buckets.append((low_value, middle_value,))
+        pending_buckets.append((middle_value, high_value,))
+
+    histogram = []
+    max_rows_below = 0
+    for (value, rows_below) in sorted(estimated_rows_below.items()):
+        # Estimates are not guaranteed to be monotonic
+        max_rows_below = max(max_rows_below, rows_below)
+        histogram.append((value, max_rows_below,))
+    verbose("Sampled %d key values; estimated number of rows: %d" % (num_samples, max_rows_below))
+    return histogram
+
+
+def get_histogram_ratio_complete(value):
+    """
+    Estimate the ratio of rows with key values lower than the given one, interpolating within
+    the histogram's buckets. Returns None when the histogram holds no rows estimate.
+    """
+    total_rows = unique_key_histogram[-1][1]
+    if not total_rows:
+        return None
+    value = int(value)
+    histogram_values = [histogram_value for (histogram_value, rows_below) in unique_key_histogram]
+    i = bisect.bisect_right(histogram_values, value)
+    if i == 0:
+        return 0.0
+    if i == len(unique_key_histogram):
+        return 1.0
+    low_value, low_rows_below = unique_key_histogram[i-1]
+    high_value, high_rows_below = unique_key_histogram[i]
+    rows_below = low_rows_below + (high_rows_below - low_rows_below) * float(value - low_value) / (high_value - low_value)
+    return min(1.0, rows_below / total_rows)
+
+
+def write_status_file(status):
+    """
+    Write given (name, value) pairs onto the status file, replacing its content atomically
+    """
+    if not options.status_file:
+        return
+    temporary_status_file_name = "%s.tmp" % options.status_file
+    status_file = open(temporary_status_file_name, "w")
+    try:
+        for (name, value) in status:
+            status_file.write("%s: %s\n" % (name, value))
+    finally:
+        status_file.close()
+    os.rename(temporary_status_file_name, options.status_file)
 
 
 def to_string_list(list):
@@ -726,7 +1143,7 @@ def sleep_after_chunk(query_execution_time):
         time.sleep(sleep_seconds)
 
 
-def act_data_pass(first_data_pass_query, rest_data_pass_query, description):
+def act_data_pass(first_data_pass_query, rest_data_pass_query, description, execute_data_pass_function=act_query):
     # Is there any range to work with, at all?
     if not range_exists:
         return
@@ -736,6 +1153,11 @@ def act_data_pass(first_data_pass_query, rest_data_pass_query, description):
         """ % (get_unique_key_min_values_variables(), get_unique_key_range_start_variables())
     act_query(query)
 
+    estimated_total_rows_count = None
+    if unique_key_type not in ["integer", "temporal"]:
+        estimated_total_rows_count = get_estimated_total_rows_count()
+        verbose("Estimated number of rows: %d" % estimated_total_rows_count)
+
     start_time = time.time()
     elapsed_times = []
 
@@ -758,14 +1180,18 @@ def act_data_pass(first_data_pass_query, rest_data_pass_query, description):
         if total_num_attempts % 20 == 0:
             verbose("- Reminder: altering %s.%s: %s..." % (database_name, original_table_name, options.alter_statement[0:30])) 
         if unique_key_type == "integer":
-            ratio_complete_query = """
-                SELECT
-                    IFNULL((@unique_key_range_start_0-@unique_key_min_value_0)/
-                    (@unique_key_max_value_0-@unique_key_min_value_0), 1)
-                    AS ratio_complete
-                """
-            ratio_complete = float(get_row(ratio_complete_query)["ratio_complete"])
-            verbose("%s range (%s), (%s), %s" % (description, ",".join(to_string_list(unique_key_range_start_values)), ",".join(to_string_list(unique_key_range_end_values)), get_progress_and_eta_presentation(elapsed_times, elapsed_time, ratio_complete)))
+            ratio_complete = None
+            if unique_key_histogram:
+                ratio_complete = get_histogram_ratio_complete(unique_key_range_start_values[0])
+            if ratio_complete is None:
+                ratio_complete_query = """
+                    SELECT
+                        IFNULL((@unique_key_range_start_0-@unique_key_min_value_0)/
+                        (@unique_key_max_value_0-@unique_key_min_value_0), 1)
+                        AS ratio_complete
+                    """
+                ratio_complete = float(get_row(ratio_complete_query)["ratio_complete"])
+            range_presentation = "(%s), (%s)" % (",".join(to_string_list(unique_key_range_start_values)), ",".join(to_string_list(unique_key_range_end_values)))
         elif unique_key_type == "temporal":
             ratio_complete_query = """
                 SELECT
@@ -774,9 +1200,22 @@ def act_data_pass(first_data_pass_query, rest_data_pass_query, description):
                     AS ratio_complete
                 """
             ratio_complete = float(get_row(ratio_complete_query)["ratio_complete"])
-            verbose("%s range ('%s', '%s'), %s" % (description, ",".join(unique_key_range_start_values), ",".join(unique_key_range_end_values), get_progress_and_eta_presentation(elapsed_times, elapsed_time, ratio_complete)))
+            range_presentation = "('%s', '%s')" % (",".join(unique_key_range_start_values), ",".join(unique_key_range_end_values))
         else:
-            verbose("%s range (%s), (%s), progress: N/A" % (description, ",".join(unique_key_range_start_values), ",".join(unique_key_range_end_values)))
+            ratio_complete = get_estimated_ratio_complete(estimated_total_rows_count)
+            range_presentation = "(%s), (%s)" % (",".join(to_string_list(unique_key_range_start_values)), ",".join(to_string_list(unique_key_range_end_values)))
+        progress, eta_seconds, eta_valid = get_progress_and_eta(elapsed_times, elapsed_time, ratio_complete)
+        verbose("%s range %s, %s" % (description, range_presentation, get_progress_and_eta_presentation(progress, eta_seconds, eta_valid)))
+        write_status_file([
+            ("table", "%s.%s" % (database_name, original_table_name)),
+            ("pass", description),
+            ("progress", "%d%%" % progress),
+            ("eta", get_eta_presentation(eta_seconds, eta_valid)),
+            ("elapsed_seconds", int(elapsed_time)),
+            ("rows", total_num_affected_rows),
+            ("range", range_presentation),
+            ("updated", time.strftime("%Y-%m-%d %H:%M:%S")),
+            ])
 
         if options.lock_chunks:
             lock_tables_read()
@@ -788,7 +1227,7 @@ def act_data_pass(first_data_pass_query, rest_data_pass_query, description):
             try:
                 query_start_time = time.time()
                 total_num_attempts += 1
-                num_affected_rows = act_query(execute_data_pass_query)
+                num_affected_rows = execute_data_pass_function(execute_data_pass_query)
                 total_num_affected_rows += num_affected_rows
                 query_execution_time = (time.time() - query_start_time)
                 retry_data_pass = False
@@ -804,6 +1243,9 @@ def act_data_pass(first_data_pass_query, rest_data_pass_query, description):
         if options.lock_chunks:
             unlock_tables()
 
+        if change_capture_source:
+            apply_pending_change_events()
+
         if is_range_degenerated():
             break
         
@@ -811,9 +1253,218 @@ def act_data_pass(first_data_pass_query, rest_data_pass_query, description):
 
         sleep_after_chunk(query_execution_time)
     verbose("%s range 100%% complete. Number of rows: %s" % (description, total_num_affected_rows))
+    write_status_file([
+        ("table", "%s.%s" % (database_name, original_table_name)),
+        ("pass", description),
+        ("progress", "100%"),
+        ("eta", "00:00:00"),
+        ("elapsed_seconds", int(time.time() - start_time)),
+        ("rows", total_num_affected_rows),
+        ("updated", time.strftime("%Y-%m-%d %H:%M:%S")),
+        ])
+
+
+def get_table_columns_character_sets(read_table_name):
+    """
+    Return a mapping of column name (lowercase) to character set name; None for non textual columns.
+    JSON columns have no character set, yet are exported as utf8mb4 text, which must be converted
+    since JSON cannot be loaded from a binary string.
+    """
+    columns_character_sets = {}
+    for row in get_catalog_columns(read_table_name):
+        character_set_name = row["CHARACTER_SET_NAME"]
+        if row["DATA_TYPE"].lower() == "json":
+            character_set_name = "utf8mb4"
+        columns_character_sets[row["COLUMN_NAME"].lower()] = character_set_name
+
+    return columns_character_sets
+
+
+def get_time_presentation(value):
+    """
+    Present a timedelta (as returned for TIME columns) the way MySQL does: [-]HH:MM:SS[.ffffff]
+    """
+    total_microseconds = (value.days*24*60*60 + value.seconds)*1000000 + value.microseconds
+    sign = ""
+    if total_microseconds < 0:
+        sign = "-"
+        total_microseconds = -total_microseconds
+    total_seconds, microseconds = divmod(total_microseconds, 1000000)
+    presentation = "%s%02d:%02d:%02d" % (sign, total_seconds / (60*60), (total_seconds / 60) % 60, total_seconds % 60)
+    if microseconds:
+        presentation = "%s.%06d" % (presentation, microseconds)
+    return presentation
+
+
+def get_load_data_field(value):
+    """
+    Present a value in LOAD DATA's default format: backslash escaped, NULL as \\N
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, float):
+        value = repr(value)
+    elif isinstance(value, datetime.timedelta):
+        value = get_time_presentation(value)
+    elif isinstance(value, unicode):
+        value = value.encode("utf8")
+    elif hasattr(value, "__iter__"):
+        # SET values
+        value = ",".join(value)
+    else:
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r").replace("\0", "\\0")
+
+
+def get_load_data_query(chunk_file_name):
+    """
+    Chunk files are in the original table's raw character sets, hence loaded as binary, and
+    textual columns are converted from their original character set.
+    """
+    columns_variables = ", ".join(["@c%d" % i for i in range(0, len(load_data_columns))])
+    columns_assignments = []
+    for i in range(0, len(load_data_columns)):
+        column_name = load_data_columns[i]
+        character_set_name = original_columns_character_sets.get(column_name)
+        if character_set_name:
+            columns_assignments.append("`%s` = CONVERT(@c%d USING %s)" % (column_name, i, character_set_name))
+        else:
+            columns_assignments.append("`%s` = @c%d" % (column_name, i))
+    query = """
+        LOAD DATA LOCAL INFILE %s
+            IGNORE INTO TABLE %s.%s
+            CHARACTER SET binary
+            (%s)
+            SET %s
+        """ % (ingest_connection.literal(chunk_file_name), database_name, ghost_table_name,
+               columns_variables, ", ".join(columns_assignments))
+    return query
+
+
+def ingest_chunk_file(chunk_file_name, ingest_result):
+    """
+    Load a chunk file onto the ghost table, on the ingest connection. Runs in its own thread.
+    LOAD DATA ... IGNORE is safe to retry.
+    """
+    num_attempts = 0
+    try:
+        while True:
+            try:
+                cursor = ingest_connection.cursor()
+                ingest_result["num_affected_rows"] = cursor.execute(get_load_data_query(chunk_file_name))
+                cursor.close()
+                ingest_connection.commit()
+                return
+            except Exception, err:
+                num_attempts += 1
+                if (num_attempts >= options.max_lock_retries) and (options.max_lock_retries > 0):
+                    ingest_result["error"] = err
+                    return
+                time.sleep(1)
+    finally:
+        os.remove(chunk_file_name)
+
+
+def wait_for_chunk_ingest():
+    """
+    Wait for the pending chunk file (if any) to be loaded
+    """
+    global pending_chunk_ingest
+
+    if not pending_chunk_ingest:
+        return
+    ingest_thread, ingest_result = pending_chunk_ingest
+    ingest_thread.join()
+    pending_chunk_ingest = None
+    if ingest_result.has_key("error"):
+        exit_with_error("Failed loading chunk: %s" % ingest_result["error"])
+
+
+def export_and_ingest_chunk(export_query):
+    """
+    Export the chunk's rows onto a local file, then have it loaded in the background,
+    such that loading this chunk overlaps with exporting the next one. Rows are streamed
+    from the server rather than buffered, so that large chunks are not held in memory.
+    Returns the number of exported rows.
+    """
+    global pending_chunk_ingest
+
+    chunk_file_descriptor, chunk_file_name = tempfile.mkstemp(prefix="oak-chunk-", suffix=".txt")
+    chunk_file = os.fdopen(chunk_file_descriptor, "wb")
+    num_exported_rows = 0
+    try:
+        try:
+            cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+            cursor.execute(export_query)
+            for row in cursor:
+                chunk_file.write("%s\n" % "\t".join([get_load_data_field(value) for value in row]))
+                num_exported_rows += 1
+            cursor.close()
+        finally:
+            chunk_file.close()
+    except:
+        os.remove(chunk_file_name)
+        raise
+
+    wait_for_chunk_ingest()
+    ingest_result = {}
+    ingest_thread = threading.Thread(target=ingest_chunk_file, args=(chunk_file_name, ingest_result,))
+    ingest_thread.start()
+    pending_chunk_ingest = (ingest_thread, ingest_result,)
+    return num_exported_rows
+
+
+def load_data_copy_pass():
+    """
+    Copy pass via LOAD DATA LOCAL INFILE. Chunks are the same key ranges as with the INSERT ... SELECT
+    copy pass. Rows are exported with no conversion of character sets, and loaded on a second
+    connection while the next chunk is being exported.
+    """
+    global ingest_connection
+    global load_data_columns
+    global original_columns_character_sets
+
+    load_data_columns = list(shared_columns)
+    original_columns_character_sets = get_table_columns_character_sets(original_table_name)
+    load_data_columns_listing = ", ".join(["`%s`" % column_name for column_name in load_data_columns])
+
+    export_queries = ["""
+        SELECT %s FROM %s.%s FORCE INDEX (%s)
+        WHERE
+            (%s
+            AND
+            %s)
+        """ % (load_data_columns_listing, database_name, original_table_name, original_table_unique_key_name,
+            get_multiple_columns_non_equality_comparison_by_names(unique_key_column_names, get_unique_key_range_start_variables(), ">", first_round),
+            get_multiple_columns_non_equality_comparison_by_names(unique_key_column_names, get_unique_key_range_end_variables(), "<", True)
+            ) for first_round in [True, False]]
+
+    ingest_connection = open_connection(local_infile = 1)
+    try:
+        if options.skip_binlog:
+            cursor = ingest_connection.cursor()
+            cursor.execute("SET SESSION SQL_LOG_BIN=0")
+            cursor.close()
+        character_set_results = get_row("SELECT @@session.character_set_results AS character_set_results")["character_set_results"]
+        act_query("SET SESSION character_set_results = binary")
+
+        act_data_pass(export_queries[0], export_queries[1], "Copying", export_and_ingest_chunk)
+        wait_for_chunk_ingest()
+
+        if character_set_results:
+            act_query("SET SESSION character_set_results = %s" % character_set_results)
+        else:
+            act_query("SET SESSION character_set_results = NULL")
+    finally:
+        ingest_connection.close()
+        ingest_connection = None
 
 
 def copy_data_pass():
+    if options.load_data:
+        load_data_copy_pass()
+        return
+
     shared_columns_listing = ", ".join(["`%s`" % shared_column for shared_column in shared_columns])
     
     # We generate two queries: 
@@ -885,6 +1536,8 @@ def rename_tables():
         """ % (database_name, original_table_name, database_name, archive_table_name,
                database_name, ghost_table_name, database_name, original_table_name, )
     act_query(query)
+    move_catalog_table(original_table_name, archive_table_name)
+    move_catalog_table(ghost_table_name, original_table_name)
     verbose("Table %s.%s has been renamed to %s.%s," % (database_name, original_table_name, database_name, archive_table_name))
     verbose("and table %s.%s has been renamed to %s.%s" % (database_name, ghost_table_name, database_name, original_table_name))
 
@@ -911,9 +1564,21 @@ def exit_with_error(error_message):
     sys.exit(1)
 
 
+# Log based change capture methods: name -> (row event source opener, current position getter)
+change_capture_backends = {
+    "binlog": (open_binlog_event_source, get_master_position,),
+    "replay": (open_replay_event_source, get_no_position,),
+    }
+
+
 try:
     try:
         conn = None
+        catalog = {"tables": {}, "columns": {}, "statistics": {}, "triggers": {}, "foreign_keys": []}
+        connection_password = None
+        change_capture_source = None
+        ingest_connection = None
+        pending_chunk_ingest = None
         (options, args) = parse_options()
 
         if not options.table:
@@ -922,6 +1587,24 @@ try:
         if options.chunk_size <= 0:
             exit_with_error("Chunk size must be nonnegative number. You can leave the default 1000 if unsure")
 
+        if options.change_capture != "triggers":
+            if not change_capture_backends.has_key(options.change_capture):
+                exit_with_error("Unknown change capture method: %s. Use one of: triggers, %s" % (options.change_capture, ", ".join(change_capture_backends.keys())))
+            if options.ghost:
+                exit_with_error("--ghost is only supported with trigger based change capture")
+            if options.change_capture_batch_size <= 0:
+                exit_with_error("Change capture batch size must be a positive number")
+        if options.load_data:
+            if options.skip_delete_pass:
+                exit_with_error("--load-data requires the DELETE data pass; cannot be used with --skip-delete-pass")
+            if options.lock_chunks:
+                exit_with_error("--load-data cannot be used with --lock-chunks")
+
+        if options.change_capture == "replay" and not options.replay_file:
+            exit_with_error("No replay file specified. Specify with --replay-file")
+        if options.replay_file and options.change_capture != "replay":
+            exit_with_error("--replay-file only applies to --change-capture=replay")
+
         database_name = None
         original_table_name =  None
         archive_table_name = None
@@ -947,20 +1630,27 @@ try:
             verbose("Binary logging for session disabled")
 
         ghost_table_name = None
-        if options.ghost:
-            if table_exists(options.ghost):
-                exit_with_error("Ghost table: %s.%s already exists." % (database_name, options.ghost))
-
         if options.ghost:
             ghost_table_name = options.ghost
         else:
             ghost_table_name = "__oak_"+original_table_name
         archive_table_name = "__arc_"+original_table_name
 
+        load_catalog([original_table_name, ghost_table_name, archive_table_name])
+
+        if options.ghost:
+            if table_exists(options.ghost):
+                exit_with_error("Ghost table: %s.%s already exists." % (database_name, options.ghost))
+
         after_delete_trigger_name = "%s_AD_oak" % original_table_name
         after_update_trigger_name = "%s_AU_oak" % original_table_name
         after_insert_trigger_name = "%s_AI_oak" % original_table_name
 
+        if options.change_capture != "triggers" and not options.cleanup:
+            # Validated before anything is created: the swap would otherwise only fail after the entire copy
+            if not validate_rename_under_lock_supported():
+                exit_with_error("--change-capture=%s requires MySQL 8.0.13 or newer" % options.change_capture)
+
         if options.cleanup:
             # All we do now is clean up
             cleanup()
@@ -970,8 +1660,12 @@ try:
                 exit_with_error("Table %s.%s does not exist" % (database_name, original_table_name))
 
             drop_custom_triggers()
-            if not validate_no_after_triggers_exist():
-                exit_with_error("Table must not have any 'AFTER' triggers defined.")
+            if options.change_capture == "triggers":
+                if not validate_no_after_triggers_exist():
+                    exit_with_error("Table must not have any 'AFTER' triggers defined.")
+            elif options.change_capture == "binlog":
+                if not validate_row_based_binary_logging():
+                    exit_with_error("Binary log change capture requires binlog_format=ROW and binlog_row_image=FULL")
 
             if not validate_no_foreign_keys_exist():
                 exit_with_error("Table must not have any foreign keys defined (neither as parent nor child).")
@@ -982,6 +1676,7 @@ try:
 
             create_ghost_table()
             alter_ghost_table()
+            load_catalog([ghost_table_name])
 
             ghost_table_unique_key_names_set = get_possible_unique_key_column_names_set(ghost_table_name)
             if not original_table_unique_key_names_set:
@@ -997,17 +1692,35 @@ try:
 
             shared_columns = get_shared_columns()
 
-            create_custom_triggers()
+            if options.change_capture == "triggers":
+                create_custom_triggers()
             lock_tables_write()
+            if options.change_capture != "triggers":
+                change_capture_source = open_change_capture_source()
             unique_key_min_values, unique_key_max_values, range_exists = get_unique_key_range()
             unlock_tables()
 
+            unique_key_histogram = None
+            if range_exists and unique_key_type == "integer":
+                unique_key_histogram = build_unique_key_histogram()
+
             copy_data_pass()
             if not options.skip_delete_pass:
                 delete_data_pass()
 
             if options.ghost:
                 verbose("Ghost table creation completed. Note that triggers on %s.%s were not removed" % (database_name, original_table_name))
+            elif change_capture_source:
+                # Tables are swapped while locked, after all events up to this point are applied:
+                # with the table locked, no further events follow once the source is caught up.
+                # This requires MySQL 8.0.13 or newer, which allows RENAME TABLE on WRITE locked tables.
+                drop_table(archive_table_name)
+                lock_tables_write()
+                apply_pending_change_events()
+                rename_tables()
+                unlock_tables()
+                drop_table(archive_table_name)
+                verbose("ALTER TABLE completed")
             else:
                 rename_tables()
                 drop_table(archive_table_name)
@@ -0,0 +1,291 @@
+#!/usr/bin/python
+
+#
+# Replay a general log capture (written by oak-hook-general-log) against a MySQL server
+#
+# Released under the BSD license
+#
+# Copyright (c) 2008-2010, Shlomi Noach
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#     * Neither the name of the organization nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+import getpass
+import MySQLdb
+import Queue
+import random
+import sys
+import threading
+import time
+import traceback
+import warnings
+from optparse import OptionParser
+try:
+    import oakcommon
+except ImportError:
+    # As installed by the deb package, the shared module is not alongside the scripts
+    sys.path.append("/usr/share/openark-kit")
+from oakcommon import get_query_fingerprint, get_capture_file_entries
+
+def parse_options():
+    usage = "usage: oak-replay-general-log [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-u", "--user", dest="user", default="", help="MySQL user")
+    parser.add_option("-H", "--host", dest="host", default="localhost", help="MySQL host (default: localhost)")
+    parser.add_option("-p", "--password", dest="password", default="", help="MySQL password")
+    parser.add_option("--ask-pass", action="store_true", dest="prompt_password", help="Prompt for password")
+    parser.add_option("-P", "--port", dest="port", type="int", default=3306, help="TCP/IP port (default: 3306)")
+    parser.add_option("-S", "--socket", dest="socket", default="/var/run/mysqld/mysql.sock", help="MySQL socket file. Only applies when host is localhost")
+    parser.add_option("", "--defaults-file", dest="defaults_file", default="", help="Read from MySQL configuration file. Overrides all other options")
+    parser.add_option("", "--input-file", dest="input_file", default=None, help="Capture file written by oak-hook-general-log --output-file. Use '-' for standard input")
+    parser.add_option("", "--speed", dest="speed", type="float", default=1.0, help="Replay speed relative to original timing; e.g. 2 replays twice as fast (default: 1)")
+    parser.add_option("", "--fast", dest="fast", action="store_true", default=False, help="Replay as fast as possible, ignoring original timing")
+    parser.add_option("", "--select-only", dest="select_only", action="store_true", default=False, help="Only replay SELECT queries")
+    parser.add_option("", "--queue-size", dest="queue_size", type="int", default=1000, help="Maximum number of queries awaiting replay per connection (default: 1000)")
+    parser.add_option("", "--report-top", dest="report_top", type="int", default=20, help="Number of top fingerprints, by total latency, to report (default: 20)")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", help="Print user friendly messages")
+    parser.add_option("", "--debug", dest="debug", action="store_true", help="Print stack trace on error")
+    return parser.parse_args()
+
+
+def verbose(message):
+    if options.verbose:
+        print "-- %s" % message
+
+def print_error(message):
+    sys.stderr.write("-- ERROR: %s\n" % message)
+
+def open_connection():
+    if options.defaults_file:
+        conn = MySQLdb.connect(
+            read_default_file = options.defaults_file)
+    else:
+        conn = MySQLdb.connect(
+            host = options.host,
+            user = options.user,
+            passwd = connection_password,
+            port = options.port,
+            unix_socket = options.socket)
+    conn.autocommit(True)
+    return conn;
+
+
+def get_event_timestamp(event_time):
+    """
+    Convert an event time, e.g. '2010-12-07 11:30:23' or '2016-01-01 10:00:00.123456', into seconds since epoch
+    """
+    event_time = str(event_time)
+    timestamp = time.mktime(time.strptime(event_time[0:19], "%Y-%m-%d %H:%M:%S"))
+    if len(event_time) > 20 and event_time[19] == ".":
+        timestamp += float(event_time[19:])
+    return timestamp
+
+
+def record_latency(fingerprint, latency, is_error):
+    """
+    Account for a replayed query. Per fingerprint, up to 1000 latencies are kept (reservoir sampled) for percentiles.
+    """
+    latency_stats_lock.acquire()
+    try:
+        if not latency_stats.has_key(fingerprint):
+            latency_stats[fingerprint] = {"count": 0, "errors": 0, "total": 0.0, "max": 0.0, "samples": []}
+        fingerprint_stats = latency_stats[fingerprint]
+        fingerprint_stats["count"] += 1
+        if is_error:
+            fingerprint_stats["errors"] += 1
+        fingerprint_stats["total"] += latency
+        fingerprint_stats["max"] = max(fingerprint_stats["max"], latency)
+        samples = fingerprint_stats["samples"]
+        if len(samples) < 1000:
+            samples.append(latency)
+        else:
+            sample_index = random.randint(0, fingerprint_stats["count"] - 1)
+            if sample_index < 1000:
+                samples[sample_index] = latency
+    finally:
+        latency_stats_lock.release()
+
+
+def replay_worker(replay_queue):
+    """
+    Replay the queries of a single original connection, in order, on a connection of its own.
+    The connection's database follows that of the original connection.
+    """
+    conn = None
+    database = None
+    try:
+        while True:
+            entry = replay_queue.get()
+            if entry is None:
+                return
+            query = entry["argument"]
+            fingerprint = get_query_fingerprint(query)
+            start_time = time.time()
+            is_error = False
+            try:
+                if conn is None:
+                    conn = open_connection()
+                    database = None
+                cursor = conn.cursor()
+                if entry["database"] and entry["database"] != database:
+                    cursor.execute("USE %s" % entry["database"])
+                    database = entry["database"]
+                    start_time = time.time()
+                cursor.execute(query)
+                cursor.close()
+            except Exception, err:
+                is_error = True
+                verbose("%s: %s" % (err, fingerprint))
+                if isinstance(err, MySQLdb.OperationalError) and conn:
+                    # Connection may be lost; reconnect on next query
+                    try:
+                        conn.close()
+                    except:
+                        pass
+                    conn = None
+            record_latency(fingerprint, time.time() - start_time, is_error)
+    finally:
+        if conn:
+            conn.close()
+
+
+def put_replay_entry(replay_queue, entry):
+    """
+    Queue an entry for replay; blocks while the queue is full
+    """
+    while True:
+        try:
+            # A timeout keeps this interruptible by Ctrl-C
+            replay_queue.put(entry, True, 0.5)
+            return
+        except Queue.Full:
+            pass
+
+
+def get_replay_queue(thread_id):
+    """
+    Return the queue of the replay thread standing for given original connection, starting one if needed
+    """
+    if not replay_queues.has_key(thread_id):
+        replay_queue = Queue.Queue(options.queue_size)
+        replay_thread = threading.Thread(target=replay_worker, args=(replay_queue,))
+        replay_thread.setDaemon(True)
+        replay_thread.start()
+        replay_queues[thread_id] = replay_queue
+        replay_threads.append(replay_thread)
+    return replay_queues[thread_id]
+
+
+def replay_general_log():
+    """
+    Dispatch captured queries to their connections' replay threads, on original (or scaled) timing
+    """
+    global max_schedule_lag
+
+    first_event_timestamp = None
+    for entry in get_capture_file_entries(options.input_file, verbose):
+        command_type = entry["command_type"]
+        thread_id = entry["thread_id"]
+        if command_type == "Quit":
+            if replay_queues.has_key(thread_id):
+                put_replay_entry(replay_queues.pop(thread_id), None)
+            continue
+        if command_type not in ["Query", "Execute"]:
+            continue
+        if options.select_only and not entry["argument"].lower().strip().startswith("select"):
+            continue
+
+        if not options.fast:
+            event_timestamp = get_event_timestamp(entry["event_time"])
+            if first_event_timestamp is None:
+                first_event_timestamp = event_timestamp
+            scheduled_time = replay_start_time + (event_timestamp - first_event_timestamp) / options.speed
+            schedule_lag = time.time() - scheduled_time
+            if schedule_lag < 0:
+                time.sleep(-schedule_lag)
+            else:
+                max_schedule_lag = max(max_schedule_lag, schedule_lag)
+        put_replay_entry(get_replay_queue(thread_id), entry)
+
+    for thread_id in replay_queues.keys():
+        put_replay_entry(replay_queues.pop(thread_id), None)
+    for replay_thread in replay_threads:
+        while replay_thread.isAlive():
+            replay_thread.join(0.5)
+
+
+def print_report():
+    """
+    Print overall throughput, and per fingerprint latency, top total latency first
+    """
+    elapsed_seconds = time.time() - replay_start_time
+    num_queries = sum([fingerprint_stats["count"] for fingerprint_stats in latency_stats.values()])
+    num_errors = sum([fingerprint_stats["errors"] for fingerprint_stats in latency_stats.values()])
+    print "-- replayed %d queries (%d errors) on %d connections in %.1f seconds: %.1f queries/sec" % (num_queries, num_errors, len(replay_threads), elapsed_seconds, num_queries / max(elapsed_seconds, 0.001))
+    if not options.fast:
+        print "-- max lag behind original timing: %.3f seconds" % max_schedule_lag
+    print "-- count\terrors\ttotal_ms\tavg_ms\tp95_ms\tmax_ms\tfingerprint"
+    sorted_latency_stats = sorted(latency_stats.items(), key=lambda (fingerprint, fingerprint_stats): -fingerprint_stats["total"])
+    for (fingerprint, fingerprint_stats) in sorted_latency_stats[0:options.report_top]:
+        samples = sorted(fingerprint_stats["samples"])
+        p95_latency = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        print "%d\t%d\t%.1f\t%.3f\t%.3f\t%.3f\t%s" % (fingerprint_stats["count"], fingerprint_stats["errors"],
+            fingerprint_stats["total"] * 1000, fingerprint_stats["total"] * 1000 / fingerprint_stats["count"],
+            p95_latency * 1000, fingerprint_stats["max"] * 1000, fingerprint)
+    sys.stdout.flush()
+
+
+def exit_with_error(error_message):
+    """
+    Notify and exit.
+    """
+    print_error(error_message)
+    exit(1)
+
+
+try:
+    try:
+        conn = None
+        (options, args) = parse_options()
+
+        if not options.input_file:
+            exit_with_error("No capture file specified (use --input-file)")
+        if options.speed <= 0:
+            exit_with_error("--speed must be positive")
+
+        connection_password = options.password
+        if options.prompt_password and not options.defaults_file:
+            connection_password = getpass.getpass()
+
+        replay_queues = {}
+        replay_threads = []
+        latency_stats = {}
+        latency_stats_lock = threading.Lock()
+        max_schedule_lag = 0.0
+
+        warnings.simplefilter("ignore", MySQLdb.Warning) 
+        # Verify connectivity before any replay takes place
+        conn = open_connection()
+
+        replay_start_time = time.time()
+        try:
+            replay_general_log()
+        except KeyboardInterrupt:
+            # Catch a Ctrl-C. Still report on what has been replayed so far.
+            pass
+        print_report()
+    except Exception, err:
+        if options.debug:
+            traceback.print_exc()
+        print err
+finally:
+    if conn:
+        conn.close()
@@ -20,6 +20,9 @@
 import sys
 import getpass
 import MySQLdb
+import Queue
+import threading
+import time
 from optparse import OptionParser
 import ConfigParser
 
@@ -35,6 +38,9 @@ def parse_options():
     parser.add_option("-n", "--expect-num-slaves", dest="expect_num_slaves", type="int", default="0", help="Number of slaves to expect (default: 0)")
     parser.add_option("-d", "--normal-delay", dest="normal_delay", type="int", default=0, help="Acceptable seconds behind master for slaves")
     parser.add_option("", "--skip-show-slave-hosts", action="store_true", dest="skip_show_slave_hosts", help="Do not use SHOW SLAVE HOSTS to find slaves")
+    parser.add_option("", "--max-concurrency", dest="max_concurrency", type="int", default=16, help="Maximum number of slaves to probe concurrently (default: 16)")
+    parser.add_option("", "--connect-timeout-seconds", dest="connect_timeout_seconds", type="int", default=5, help="Per slave connect timeout (default: 5)")
+    parser.add_option("", "--read-timeout-seconds", dest="read_timeout_seconds", type="int", default=5, help="Per slave time allowed for reading slave status, once connected (default: 5)")
     return parser.parse_args()
 
 def verbose(message):
@@ -139,39 +145,103 @@ def get_slave_hosts_and_ports():
     return found_slave_hosts_and_ports
 
 
-def show_slaves_master_log_files():
+def get_slave_status_line(slave_host, slave_port):
     """
-    Get the list of master logs reported by all slaves (one master logs per found slave)
+    Probe a single slave, over a connection of its own. Return its status line, or else an error message
     """
-    verbose("Slave host\tSlave port\tMaster_Log_File\tSeconds_Behind_Master\tStatus")
-    for (slave_host, slave_port,) in slave_hosts_and_ports:
-        slave_connection = None
+    slave_connection = None
+    try:
         try:
+            slave_connection = MySQLdb.connect(host = slave_host, user = username, passwd = password, port = slave_port, connect_timeout = options.connect_timeout_seconds)
+            slave_cursor = slave_connection.cursor(MySQLdb.cursors.DictCursor)
+            slave_cursor.execute("SHOW SLAVE STATUS")
+            slave_status = slave_cursor.fetchone()
+            slave_master_log_file = slave_status["Master_Log_File"]
+            seconds_behind_master = int(slave_status["Seconds_Behind_Master"])
+            slave_cursor.close()
+            if seconds_behind_master <= options.normal_delay:
+                status = "Good"
+            elif slave_master_log_file == current_master_log:
+                status = "Lag"
+            else:
+                status = "Far behind"
+            return ("%s\t%d\t%s\t%s\t%s" % (slave_host, slave_port, slave_master_log_file, seconds_behind_master, status), None)
+        except:
+            return (None, "Cannot SHOW SLAVE STATUS on %s:%d" % (slave_host, slave_port,))
+    finally:
+        if slave_connection:
             try:
-                slave_connection = MySQLdb.connect(host = slave_host, user = username, passwd = password, port = slave_port)
-                slave_cursor = slave_connection.cursor(MySQLdb.cursors.DictCursor)
-                slave_cursor.execute("SHOW SLAVE STATUS")
-                slave_status = slave_cursor.fetchone()
-                slave_master_log_file = slave_status["Master_Log_File"]
-                seconds_behind_master = int(slave_status["Seconds_Behind_Master"])
-                slave_cursor.close()
-                if seconds_behind_master <= options.normal_delay:
-                    status = "Good"
-                elif slave_master_log_file == current_master_log:
-                    status = "Lag"
-                else:
-                    status = "Far behind"
-                verbose("%s\t%d\t%s\t%s\t%s" % (slave_host, slave_port, slave_master_log_file, seconds_behind_master, status))
-            except:
-                print_error("Cannot SHOW SLAVE STATUS on %s:%d" % (slave_host, slave_port,))
-        finally:
-            if slave_connection:
                 slave_connection.close()
+            except:
+                pass
+
+
+def probe_slaves():
+    """
+    Pool worker: probe pending slaves one at a time, until none are left
+    """
+    while True:
+        try:
+            slave_index = pending_slave_indexes.get_nowait()
+        except Queue.Empty:
+            return
+        probe_start_times[slave_index] = time.time()
+        (slave_host, slave_port,) = slave_hosts_and_ports[slave_index]
+        probe_results.put((slave_index, get_slave_status_line(slave_host, slave_port)))
+
+
+def start_probe_thread():
+    probe_thread = threading.Thread(target=probe_slaves)
+    probe_thread.setDaemon(True)
+    probe_thread.start()
+
+
+def show_slaves_master_log_files():
+    """
+    Get the list of master logs reported by all slaves (one master logs per found slave).
+    Slaves are probed concurrently by a pool of up to --max-concurrency threads. A probe exceeding the connect and
+    read timeouts is reported as timed out, and its thread is abandoned and replaced, so that an unresponsive slave
+    does not hold back the others. Results are listed in order of slaves, once all are probed.
+    """
+    verbose("Slave host\tSlave port\tMaster_Log_File\tSeconds_Behind_Master\tStatus")
+    for slave_index in range(len(slave_hosts_and_ports)):
+        pending_slave_indexes.put(slave_index)
+    for i in range(min(options.max_concurrency, len(slave_hosts_and_ports))):
+        start_probe_thread()
+
+    probe_timeout_seconds = options.connect_timeout_seconds + options.read_timeout_seconds
+    slave_status_lines = {}
+    while len(slave_status_lines) < len(slave_hosts_and_ports):
+        try:
+            (slave_index, slave_status_line) = probe_results.get(True, 0.1)
+            if not slave_status_lines.has_key(slave_index):
+                slave_status_lines[slave_index] = slave_status_line
+        except Queue.Empty:
+            pass
+        now = time.time()
+        for (slave_index, probe_start_time) in probe_start_times.items():
+            if not slave_status_lines.has_key(slave_index) and now - probe_start_time > probe_timeout_seconds:
+                (slave_host, slave_port,) = slave_hosts_and_ports[slave_index]
+                slave_status_lines[slave_index] = (None, "Timed out probing %s:%d" % (slave_host, slave_port,))
+                start_probe_thread()
+
+    for slave_index in range(len(slave_hosts_and_ports)):
+        (status_line, error_message) = slave_status_lines[slave_index]
+        if status_line:
+            verbose(status_line)
+        else:
+            print_error(error_message)
 
 try:
     try:
         master_connection = None
+        pending_slave_indexes = Queue.Queue()
+        probe_start_times = {}
+        probe_results = Queue.Queue()
         (options, args) = parse_options()
+        if options.max_concurrency < 1:
+            print_error("--max-concurrency must be a positive number")
+            sys.exit(1)
         master_connection, username, password, port_number = open_master_connection()
 
         master_logs = get_master_logs()
@@ -0,0 +1,155 @@
+#
+# Code shared by the tools: query fingerprinting, and the general log capture file format
+# (written by oak-hook-general-log, read by oak-hook-general-log and oak-replay-general-log)
+#
+# Released under the BSD license
+#
+# Copyright (c) 2008-2010, Shlomi Noach
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#     * Neither the name of the organization nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import itertools
+import re
+import struct
+import sys
+
+fingerprint_regexps = [
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'", re.S), "?"),
+    (re.compile(r'"(?:[^"\\]|\\.|"")*"', re.S), "?"),
+    (re.compile(r"/\*.*?\*/", re.S), " "),
+    (re.compile(r"(--(?=\s)|#)[^\n]*"), " "),
+    (re.compile(r"\b0x[0-9a-f]+\b", re.I), "?"),
+    (re.compile(r"(?<![\w$])-?\d+(\.\d+)?(e[-+]?\d+)?\b", re.I), "?"),
+    (re.compile(r"\s+"), " "),
+    (re.compile(r"\bin\s*\(\s*\?(\s*,\s*\?)*\s*\)", re.I), "in (?+)"),
+    (re.compile(r"\bvalues\s*\([^()]*\)(\s*,\s*\([^()]*\))+", re.I), "values (?+)"),
+    ]
+
+capture_fields = ["event_time", "user_host", "thread_id", "server_id", "command_type", "argument", "database", "weight"]
+compact_capture_header = "OAKCAP1\n"
+
+
+def get_query_fingerprint(query):
+    """
+    Normalize a query into its shape: comments removed, literals replaced by '?',
+    IN lists and multi row VALUES collapsed, whitespace compacted, lowercased.
+    """
+    fingerprint = query
+    for (fingerprint_regexp, replacement) in fingerprint_regexps:
+        fingerprint = fingerprint_regexp.sub(replacement, fingerprint)
+    return fingerprint.strip().lower()
+
+
+def write_capture_header(capture_file, capture_format):
+    if capture_format == "compact":
+        capture_file.write(compact_capture_header)
+
+
+def write_capture_entry(capture_file, capture_format, entry):
+    """
+    Write an entry as a JSON line, or as a compact record: per field, a 4 byte length (-1 for NULL) followed by the value.
+    JSON holds text as unicode: an argument which is not valid UTF-8 (e.g. binary data) is stored as latin-1, which is lossless.
+    """
+    values = [entry.get(field) for field in capture_fields]
+    if values[0] is not None:
+        values[0] = str(values[0])
+    if capture_format == "compact":
+        for value in values:
+            if value is None:
+                capture_file.write(struct.pack(">i", -1))
+            else:
+                value = str(value)
+                capture_file.write(struct.pack(">i", len(value)))
+                capture_file.write(value)
+    else:
+        # Imported here: json requires python 2.6, and is only needed for JSON capture files
+        import json
+        record = dict(zip(capture_fields, values))
+        try:
+            line = json.dumps(record)
+        except UnicodeDecodeError:
+            record["encoding"] = "latin-1"
+            line = json.dumps(record, encoding="latin-1")
+        capture_file.write(line)
+        capture_file.write("\n")
+
+
+def get_capture_entry(values):
+    entry = dict(zip(capture_fields, values))
+    for field in ["thread_id", "server_id"]:
+        if entry[field] is not None:
+            entry[field] = int(entry[field])
+    if entry["weight"] is None:
+        entry["weight"] = 1.0
+    entry["weight"] = float(entry["weight"])
+    return entry
+
+
+def get_compact_capture_entries(input_file, verbose):
+    while True:
+        values = []
+        for field in capture_fields:
+            length_bytes = input_file.read(4)
+            if not length_bytes and not values:
+                return
+            if len(length_bytes) < 4:
+                verbose("Truncated capture record ignored")
+                return
+            (length,) = struct.unpack(">i", length_bytes)
+            if length < 0:
+                values.append(None)
+            else:
+                value = input_file.read(length)
+                if len(value) < length:
+                    verbose("Truncated capture record ignored")
+                    return
+                values.append(value)
+        yield get_capture_entry(values)
+
+
+def get_json_capture_entries(lines):
+    import json
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        encoding = record.get("encoding", "utf-8")
+        values = []
+        for field in capture_fields:
+            value = record.get(field)
+            if isinstance(value, unicode):
+                value = value.encode(encoding)
+            values.append(value)
+        yield get_capture_entry(values)
+
+
+def get_capture_file_entries(input_file_name, verbose):
+    """
+    Stream entries off a capture file ('-' for standard input); format is detected by the compact header.
+    The given verbose function reports truncated records.
+    """
+    if input_file_name == "-":
+        input_file = sys.stdin
+    else:
+        input_file = open(input_file_name, "rb", 1024*1024)
+    try:
+        header = input_file.read(len(compact_capture_header))
+        if header == compact_capture_header:
+            entries = get_compact_capture_entries(input_file, verbose)
+        else:
+            # Put back what has been read of the first line
+            lines = itertools.chain((header + input_file.readline()).splitlines(), input_file)
+            entries = get_json_capture_entries(lines)
+        for entry in entries:
+            yield entry
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()